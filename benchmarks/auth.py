@@ -0,0 +1,206 @@
+"""
+Load and latency benchmark of the auth paths, run in process against a
+temporary sqlite database seeded with --users users. Prints JSON results,
+compare runs between commits with the same arguments.
+
+    python -m benchmarks.auth --users 100000 --concurrency 1,8,32 -o bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+SCENARIOS = ["token", "me", "get_user", "all", "update_user"]
+PASSWORD = "benchpass"
+SEED_CHUNK_SIZE = 10_000
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=500, help="per run")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--page-size", type=int, default=100, help="for /users/all")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=Path, help="default to stdout")
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace, db_path: Path) -> None:
+    # must run before the app and config.settings are imported
+    os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ["LOGIN_USERNAME_BURST"] = str(10**9)
+    os.environ["LOGIN_CLIENT_BURST"] = str(10**9)
+
+
+def seed_users(count: int) -> None:
+    """
+    Insert a superuser and count users sharing one password hash.
+    """
+    from controllers.token import get_password_hash
+    from models.user import UserTable
+    from sqlalchemy import insert
+    from utils.database import Base, engine
+
+    Base.metadata.create_all(bind=engine)
+    hashed_password = get_password_hash(PASSWORD)
+
+    def chunk(start: int) -> list:
+        # built per chunk, memory stays flat for millions of users
+        return [
+            dict(
+                username=f"user{i}",
+                email=f"user{i}@example.com",
+                full_name=f"User {i}",
+                hashed_password=hashed_password,
+                is_active=True,
+                is_superuser=i == 0,
+            )
+            for i in range(start, min(start + SEED_CHUNK_SIZE, count + 1))
+        ]
+
+    with engine.begin() as connection:
+        for start in range(0, count + 1, SEED_CHUNK_SIZE):
+            connection.execute(insert(UserTable), chunk(start))
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_load(make_request, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await make_request()
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 1),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> list:
+    import httpx
+    from main import app
+
+    rng = random.Random(args.seed)
+    transport = httpx.ASGITransport(app=app, client=("127.0.0.1", 12345))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+
+        async def login(username: str) -> httpx.Response:
+            return await c.post(
+                "/users/token", data={"username": username, "password": PASSWORD}
+            )
+
+        superuser_token = (await login("user0")).json()["access_token"]
+        user_token = (await login("user1")).json()["access_token"]
+        superuser = {"Authorization": f"Bearer {superuser_token}"}
+
+        def random_id() -> int:
+            return rng.randint(2, args.users + 1)
+
+        requests = {
+            "token": lambda: login(f"user{rng.randint(1, args.users)}"),
+            "me": lambda: c.get(
+                "/users/me", headers={"Authorization": f"Bearer {user_token}"}
+            ),
+            "get_user": lambda: c.get(
+                "/users/", headers=superuser, params={"user_id": random_id()}
+            ),
+            "all": lambda: c.get(
+                "/users/all",
+                headers=superuser,
+                params={
+                    "limit": args.page_size,
+                    "after_id": rng.randint(0, max(0, args.users - args.page_size)),
+                },
+            ),
+            "update_user": lambda: c.put(
+                f"/users/{random_id()}",
+                headers=superuser,
+                json={"full_name": f"Renamed {rng.random()}"},
+            ),
+        }
+
+        results = []
+        for scenario in args.scenarios.split(","):
+            for concurrency in map(int, args.concurrency.split(",")):
+                result = await run_load(requests[scenario], args.requests, concurrency)
+                result = {"scenario": scenario, "concurrency": concurrency, **result}
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+        return results
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configure_environment(args, Path(tmp_dir) / "bench.db")
+        seed_started = time.perf_counter()
+        seed_users(args.users)
+        seed_seconds = time.perf_counter() - seed_started
+        results = asyncio.run(run_benchmark(args))
+
+    report = {
+        "meta": {
+            "commit": get_commit(),
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "users": args.users,
+            "requests": args.requests,
+            "bcrypt_rounds": args.bcrypt_rounds,
+            "seed_seconds": round(seed_seconds, 2),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Micro-benchmark of the JWT codec backends, in tokens per second.
+Backends which aren't installed are skipped.
+
+    python -m benchmarks.jwt_codec --algorithm HS256 --tokens 20000
+"""
+import argparse
+import json
+import sys
+import time
+import uuid
+
+from utils.jwt_codec import CODECS, get_codec
+from utils.keys import generate_private_key
+
+
+def measure(fn, tokens: list) -> float:
+    start = time.perf_counter()
+    for token in tokens:
+        fn(token)
+    return len(tokens) / (time.perf_counter() - start)
+
+
+def bench_codec(backend: str, algorithm: str, count: int) -> dict:
+    codec = get_codec(backend, algorithm)
+    if algorithm.startswith("HS"):
+        material = "bench-secret"
+    else:
+        material = generate_private_key(algorithm)
+    private_key, public_key = codec.prepare_keys(material)
+    kid = None if algorithm.startswith("HS") else uuid.uuid4().hex
+    exp = int(time.time()) + 3600
+    # the claims issue_token puts in access tokens
+    claims = [
+        {"sub": f"user{i}", "uid": i, "scp": 1, "exp": exp, "jti": uuid.uuid4().hex}
+        for i in range(count)
+    ]
+    encode_rate = measure(lambda c: codec.encode(c, private_key, kid), claims)
+    tokens = [codec.encode(c, private_key, kid) for c in claims]
+    decode_rate = measure(lambda t: codec.decode(t, public_key), tokens)
+    return {
+        "backend": backend,
+        "algorithm": algorithm,
+        "encode_per_second": round(encode_rate),
+        "decode_per_second": round(decode_rate),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--algorithm", default="HS256")
+    parser.add_argument("--tokens", type=int, default=20_000)
+    parser.add_argument("--backends", default=",".join(CODECS))
+    args = parser.parse_args()
+
+    for backend in args.backends.split(","):
+        try:
+            result = bench_codec(backend, args.algorithm, args.tokens)
+        except (ImportError, ValueError) as e:
+            print(f"skipping {backend}: {e}", file=sys.stderr)
+            continue
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
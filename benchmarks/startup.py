@@ -0,0 +1,75 @@
+"""
+Cold start benchmark: time importing the app and running its startup in
+fresh interpreters, against a temporary sqlite database.
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CHILD = """
+import asyncio, json, time
+start = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+
+async def start_app():
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+    return started
+
+started = asyncio.run(start_app())
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "startup_ms": (started - imported) * 1000,
+}))
+"""
+
+
+def run_once(env: dict) -> dict:
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+    # includes the interpreter start and shutdown
+    result["process_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--no-create-all", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(
+            os.environ,
+            SQLALCHEMY_DATABASE_URL=f"sqlite:///{Path(tmp_dir) / 'startup.db'}",
+            DB_CREATE_ALL=str(not args.no_create_all),
+        )
+        # the first run creates the tables and warms the file cache
+        run_once(env)
+        runs = [run_once(env) for _ in range(args.runs)]
+
+    report = {
+        name: round(statistics.median(run[name] for run in runs), 1)
+        for name in ("import_ms", "startup_ms", "process_ms")
+    }
+    print(json.dumps({"runs": args.runs, "median": report}))
+
+
+if __name__ == "__main__":
+    main()
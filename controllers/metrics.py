@@ -0,0 +1,134 @@
+from anyio.to_thread import current_default_thread_limiter
+from controllers.token import hashing_executor
+from controllers.user import principal_cache, stats_cache, token_cache
+from fastapi import Response
+from sqlalchemy import Engine, event
+from sqlalchemy.pool import QueuePool
+from utils.database import async_engine, engine, replica_engines
+from utils.metrics import registry
+
+ENGINES = {
+    "sync": engine,
+    "async": async_engine.sync_engine,
+    **{
+        f"replica{index}": replica_engine.sync_engine
+        for index, replica_engine in enumerate(replica_engines)
+    },
+}
+CACHES = {
+    "token": token_cache,
+    "principal": principal_cache,
+    "user_stats": stats_cache,
+}
+
+pool_checked_out = registry.gauge(
+    "db_pool_connections_checked_out",
+    "Database connections currently checked out of the pool.",
+    labels=("engine",),
+)
+
+
+def watch_pool(name: str, sync_engine: Engine) -> None:
+    pool_checked_out.set(name, value=0)
+    event.listen(sync_engine, "checkout", lambda *_: pool_checked_out.inc(name))
+    event.listen(sync_engine, "checkin", lambda *_: pool_checked_out.dec(name))
+
+
+for name, sync_engine in ENGINES.items():
+    watch_pool(name, sync_engine)
+
+
+def collect_pool_size() -> dict:
+    # only QueuePool keeps a fixed number of connections
+    return {
+        (name,): sync_engine.pool.size()
+        for name, sync_engine in ENGINES.items()
+        if isinstance(sync_engine.pool, QueuePool)
+    }
+
+
+def collect_cache(attribute: str) -> dict:
+    return {(name,): getattr(cache, attribute) for name, cache in CACHES.items()}
+
+
+def collect_threads_busy() -> dict:
+    threads = {
+        ("password-hashing",): min(
+            hashing_executor.pending, hashing_executor.max_workers
+        )
+    }
+    try:
+        threads[("anyio",)] = current_default_thread_limiter().borrowed_tokens
+    except RuntimeError:
+        # not called from the event loop
+        pass
+    return threads
+
+
+def collect_threads_max() -> dict:
+    threads = {("password-hashing",): hashing_executor.max_workers}
+    try:
+        threads[("anyio",)] = current_default_thread_limiter().total_tokens
+    except RuntimeError:
+        pass
+    return threads
+
+
+registry.gauge(
+    "db_pool_size",
+    "Connections the pool keeps open, beyond which it overflows.",
+    labels=("engine",),
+    callback=collect_pool_size,
+)
+registry.counter(
+    "cache_hits_total",
+    "Cache lookups that found a live entry.",
+    labels=("cache",),
+    callback=lambda: collect_cache("hits"),
+)
+registry.counter(
+    "cache_misses_total",
+    "Cache lookups that found no live entry.",
+    labels=("cache",),
+    callback=lambda: collect_cache("misses"),
+)
+registry.gauge(
+    "cache_hit_ratio",
+    "Share of cache lookups that were hits since start.",
+    labels=("cache",),
+    callback=lambda: collect_cache("hit_ratio"),
+)
+registry.gauge(
+    "cache_entries",
+    "Entries held by the cache.",
+    labels=("cache",),
+    callback=lambda: {(name,): len(cache) for name, cache in CACHES.items()},
+)
+registry.gauge(
+    "threadpool_threads_busy",
+    "Worker threads running a call.",
+    labels=("pool",),
+    callback=collect_threads_busy,
+)
+registry.gauge(
+    "threadpool_threads_max",
+    "Worker threads the pool may run at once.",
+    labels=("pool",),
+    callback=collect_threads_max,
+)
+registry.gauge(
+    "threadpool_queued_calls",
+    "Calls waiting for a free worker thread.",
+    labels=("pool",),
+    callback=lambda: {
+        ("password-hashing",): max(
+            0, hashing_executor.pending - hashing_executor.max_workers
+        )
+    },
+)
+
+
+def get_metrics() -> Response:
+    return Response(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
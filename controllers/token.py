@@ -1,25 +1,190 @@
 # https://fastapi.tiangolo.com/tutorial/security/oauth2-jwt/
 # jwt module
 
+import functools
+import hashlib
+import secrets
+import time
+import uuid
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Optional
+from enum import IntFlag
+from typing import TYPE_CHECKING, Any, Callable, Iterable, List, Optional
 
 from config import settings
+from fastapi import HTTPException, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt
-from passlib.context import CryptContext
+from models.token import RevokedTokenTable
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from utils.cache import ExpiringSet
+from utils.executor import BoundedExecutor, ExecutorOverloaded
+from utils.jwt_codec import get_codec
+from utils.keys import KeyRing
+from utils.metrics import stage
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+if TYPE_CHECKING:
+    from passlib.context import CryptContext
+
+
+def build_password_context() -> "CryptContext":
+    """
+    Hash with the configured scheme and cost. Hashes using another scheme or
+    another cost are reported by verify_and_update, so they can be upgraded.
+    """
+    from passlib.context import CryptContext
+
+    schemes = [settings.PASSWORD_HASH_SCHEME]
+    if settings.PASSWORD_HASH_SCHEME != "bcrypt":
+        schemes.append("bcrypt")
+    options = dict(
+        bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+        bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+        bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+    )
+    if "argon2" in schemes:
+        options.update(
+            argon2__time_cost=settings.ARGON2_TIME_COST,
+            argon2__memory_cost=settings.ARGON2_MEMORY_COST,
+            argon2__parallelism=settings.ARGON2_PARALLELISM,
+        )
+    return CryptContext(schemes=schemes, deprecated="auto", **options)
+
+
+@functools.cache
+def get_password_context() -> "CryptContext":
+    # built on first use, importing passlib slows down startup
+    return build_password_context()
+
+
+hashing_executor = BoundedExecutor(
+    max_workers=settings.PASSWORD_HASHING_WORKERS,
+    max_queue=settings.PASSWORD_HASHING_MAX_QUEUE,
+    thread_name_prefix="password-hashing",
+)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="users/token")
 
 
-def verify_password(plain_password, hashed_password) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+class Scope(IntFlag):
+    """
+    Scopes carried by access tokens as a bitmask in the "scp" claim.
+    """
+
+    ACTIVE = 1
+    SUPERUSER = 2
+
+
+def get_scopes(is_active: bool, is_superuser: bool) -> Scope:
+    scopes = Scope(0)
+    if is_active:
+        scopes |= Scope.ACTIVE
+    if is_superuser:
+        scopes |= Scope.SUPERUSER
+    return scopes
+
+
+key_ring = KeyRing(
+    algorithm=settings.ALGORITHM,
+    secret_key=settings.SECRET_KEY,
+    keys_dir=settings.JWT_KEYS_DIR,
+    rotation_minutes=settings.JWT_KEY_ROTATION_MINUTES,
+    # keep retired keys until the tokens they signed have expired
+    retention_minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES,
+    codec=get_codec(settings.JWT_BACKEND, settings.ALGORITHM),
+    secret_key_file=settings.SECRET_KEY_FILE,
+    reload_seconds=settings.KEY_RELOAD_SECONDS,
+    # verifiers may cache the JWKS this long before they see a new key
+    publish_seconds=settings.JWKS_MAX_AGE_SECONDS,
+)
+
+
+def has_shared_keys() -> bool:
+    """
+    Whether every worker signs with the same configured key material,
+    rather than a secret or key pairs generated in its own process.
+    """
+    if settings.ALGORITHM.startswith("HS"):
+        return (
+            settings.SECRET_KEY_FILE is not None
+            or "SECRET_KEY" in settings.model_fields_set
+        )
+    return settings.JWT_KEYS_DIR is not None
+
+
+def check_shared_keys() -> None:
+    """
+    Refuse generated keys in production, where workers, replicas and
+    restarts can't be counted on to share a process, and whenever several
+    workers are declared.
+    """
+    if has_shared_keys():
+        return
+    if settings.ENV == "PROD" or settings.WEB_CONCURRENCY > 1:
+        raise RuntimeError(
+            "Each worker would sign tokens with its own generated keys and "
+            "reject the tokens of the others, or of itself after a restart. "
+            "Set SECRET_KEY or SECRET_KEY_FILE, or JWT_KEYS_DIR for "
+            f"{settings.ALGORITHM}."
+        )
+
+
+def verify_and_update_password(
+    plain_password, hashed_password
+) -> tuple[bool, Optional[str]]:
+    """
+    Verify the password, also return a new hash if the stored one is outdated.
+    """
+    with stage("password.verify"):
+        return get_password_context().verify_and_update(plain_password, hashed_password)
 
 
 def get_password_hash(password) -> str:
-    return pwd_context.hash(password)
+    with stage("password.hash"):
+        return get_password_context().hash(password)
+
+
+def get_password_hashes(passwords: Iterable[str]) -> List[str]:
+    """
+    Hash many passwords in parallel on the hashing pool. At most one call per
+    worker is in flight, so the queue stays free for concurrent logins.
+    """
+    hashes = []
+    pending = deque()
+    for password in passwords:
+        if len(pending) >= hashing_executor.max_workers:
+            hashes.append(pending.popleft().result())
+        pending.append(hashing_executor.submit(get_password_hash, password, block=True))
+    hashes.extend(future.result() for future in pending)
+    return hashes
+
+
+async def verify_and_update_password_async(
+    plain_password, hashed_password
+) -> tuple[bool, Optional[str]]:
+    return await run_hashing(
+        verify_and_update_password, plain_password, hashed_password
+    )
+
+
+def hash_password_on_pool(password) -> str:
+    """
+    Hash from a sync route's thread on the hashing pool, so hashing for
+    writes shares its CPU bound with logins.
+    """
+    return hashing_executor.submit(get_password_hash, password, block=True).result()
+
+
+async def run_hashing(fn: Callable, *args: Any) -> Any:
+    try:
+        return await hashing_executor.run(fn, *args)
+    except ExecutorOverloaded:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, try again later",
+            headers={"Retry-After": "1"},
+        )
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -28,8 +193,85 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(
-        to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM
-    )
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
+    with stage("jwt.encode"):
+        encoded_jwt = key_ring.encode(to_encode)
     return encoded_jwt
+
+
+class TokenDenylist:
+    """
+    Revoked token ids held in memory for O(1) checks, persisted in the
+    revoked_tokens table and synced from it every DENYLIST_SYNC_SECONDS.
+    Entries drop out of both once the revoked token would have expired.
+    """
+
+    def __init__(self) -> None:
+        self.revoked = ExpiringSet()
+        self._last_sync = float("-inf")
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self.revoked
+
+    async def sync(self, db: AsyncSession) -> None:
+        now = time.monotonic()
+        if now - self._last_sync < settings.DENYLIST_SYNC_SECONDS:
+            return
+        self._last_sync = now
+        # all live entries, ids are reused after purges and postgres
+        # sequence values can commit out of order, so no id watermark.
+        # The table holds only unexpired revocations, revoke() purges it
+        result = await db.execute(
+            select(RevokedTokenTable.jti, RevokedTokenTable.expires_at).where(
+                RevokedTokenTable.expires_at > time.time()
+            )
+        )
+        for row in result:
+            self.revoked.add(row.jti, row.expires_at)
+
+    async def revoke(self, db: AsyncSession, jti: str, expires_at: int) -> None:
+        self.revoked.add(jti, expires_at)
+        await db.execute(
+            delete(RevokedTokenTable).where(RevokedTokenTable.expires_at <= time.time())
+        )
+        try:
+            await db.execute(
+                insert(RevokedTokenTable).values(jti=jti, expires_at=expires_at)
+            )
+            await db.commit()
+        except IntegrityError:
+            # revoked concurrently
+            await db.rollback()
+
+
+denylist = TokenDenylist()
+
+
+def hash_refresh_token(refresh_token: str) -> bytes:
+    return hashlib.sha256(refresh_token.encode()).digest()
+
+
+def new_refresh_token(user_id: int, family_id: str | None = None) -> tuple[str, dict]:
+    """
+    Return an opaque refresh token and the refresh_tokens row to store for it.
+    """
+    refresh_token = secrets.token_urlsafe(32)
+    row = dict(
+        token_hash=hash_refresh_token(refresh_token),
+        family_id=family_id or uuid.uuid4().hex,
+        user_id=user_id,
+        expires_at=int(time.time()) + settings.REFRESH_TOKEN_EXPIRE_DAYS * 86400,
+        used=False,
+    )
+    return refresh_token, row
+
+
+def get_jwks(request: Request) -> Response:
+    content, etag = key_ring.jwks()
+    headers = {
+        "Cache-Control": f"public, max-age={settings.JWKS_MAX_AGE_SECONDS}",
+        "ETag": etag,
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content, media_type="application/json", headers=headers)
@@ -1,55 +1,329 @@
+import hashlib
+import math
+import threading
+import time
 from datetime import timedelta
-from typing import List, Optional
+from typing import AsyncIterator, Callable, List, Optional
 
+import orjson
 from config import settings
 from controllers.token import (
+    Scope,
     create_access_token,
-    get_password_hash,
+    denylist,
+    get_password_hashes,
+    get_scopes,
+    hash_password_on_pool,
+    hash_refresh_token,
+    key_ring,
+    new_refresh_token,
     oauth2_scheme,
-    verify_password,
+    verify_and_update_password_async,
 )
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
-from jose import JWTError, jwt
-from models.user import UserTable
+from jose import JWTError
+from models.token import RefreshTokenTable
+from models.user import USER_SEARCH_TABLE, UserInvalidationTable, UserTable
 from pydantic import EmailStr
 from schemas.token import Token, TokenData
-from schemas.user import User, UserCreate, UserDelete, UserInDB, UserUpdate
+from schemas.user import (
+    User,
+    UserBatchGet,
+    UserBulkResult,
+    UserCreate,
+    UserDelete,
+    UserInDB,
+    UserUpdate,
+)
+from sqlalchemy import (
+    ColumnElement,
+    Integer,
+    Select,
+    Update,
+    and_,
+    case,
+    column,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from utils.database import get_db
-
-
-def get_user(
-    db: Session, user_id: int | None, username: str | None, email: EmailStr | None
+from utils.cache import ExpiringSet, TTLCache
+from utils.database import get_read_db, reads_from_replica
+from utils.metrics import stage
+from utils.ratelimit import MemoryBucketStore, SQLiteBucketStore, TokenBucketLimiter
+
+# claims of verified bearer tokens, keyed by the token digest,
+# entries expire with the token
+token_cache = TTLCache(maxsize=settings.TOKEN_CACHE_SIZE)
+# API users keyed by ("id", user_id), plus ("username", username) -> user_id,
+# kept in sync by the write paths below
+principal_cache = TTLCache(
+    maxsize=settings.PRINCIPAL_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL_SECONDS
+)
+# bumped by every invalidation, so reads started before it aren't cached
+principal_generation = 0
+principal_lock = threading.Lock()
+# the GET /users/stats counts, cleared by the write paths below
+stats_cache = TTLCache(maxsize=1, ttl=settings.USER_STATS_CACHE_TTL_SECONDS)
+if settings.LOGIN_RATE_LIMIT_BACKEND == "sqlite":
+    login_bucket_store = SQLiteBucketStore(settings.LOGIN_RATE_LIMIT_SQLITE_PATH)
+else:
+    login_bucket_store = MemoryBucketStore(settings.LOGIN_RATE_LIMIT_MAX_KEYS)
+login_limiters = {
+    "username": TokenBucketLimiter(
+        "username",
+        rate=settings.LOGIN_USERNAME_RATE_PER_MINUTE / 60,
+        burst=settings.LOGIN_USERNAME_BURST,
+        store=login_bucket_store,
+    ),
+    "client": TokenBucketLimiter(
+        "client",
+        rate=settings.LOGIN_CLIENT_RATE_PER_MINUTE / 60,
+        burst=settings.LOGIN_CLIENT_BURST,
+        store=login_bucket_store,
+    ),
+}
+# rows fetched per round-trip when streaming the users table
+STREAM_BATCH_SIZE = 500
+# values per IN (...) lookup and rows per INSERT batch, well below the
+# bind parameter limits of sqlite and postgres
+BULK_CHUNK_SIZE = 500
+# columns matched by GET /users/search
+SEARCH_COLUMNS = (UserTable.username, UserTable.email, UserTable.full_name)
+# whether the sqlite FTS5 search table exists, by database url
+_search_tables: dict[str, bool] = {}
+# the columns of the API User schema in its field order, queried as plain
+# rows to build responses without ORM objects or pydantic validation
+USER_COLUMNS = tuple(getattr(UserTable, name) for name in User.model_fields)
+
+
+async def get_user(
+    db: AsyncSession,
+    user_id: int | None,
+    username: str | None,
+    email: EmailStr | None,
 ) -> User:
     if user_id is not None:
-        db_user = get_db_user_by_id(db, user_id)
+        user = await get_user_by_id(db, user_id)
     elif username is not None:
-        db_user = get_db_user_by_username(db, username)
+        user = await get_user_by_username(db, username)
     elif email is not None:
-        db_user = get_db_user_by_email(db, email)
+        db_user = await get_db_user_by_email_async(db, email)
+        user = None if db_user is None else convert_user_for_api(db_user)
     else:
         raise HTTPException(
             status_code=404,
             detail="Invalid query. Should pass in user_id or username or email",
         )
 
-    if db_user is None:
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    user = convert_user_for_api(db_user)
     return user
 
 
+async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[User]:
+    await user_invalidations.sync(db)
+    user = get_cached_user_by_id(user_id)
+    if user is None:
+        generation = principal_generation
+        db_user = await get_db_user_by_id_async(db, user_id)
+        if db_user is None:
+            return None
+        user = convert_user_for_api(db_user)
+        # a lagging replica could cache a row an invalidation already dropped
+        if not reads_from_replica(db):
+            cache_user(user, generation)
+    return user
+
+
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[User]:
+    await user_invalidations.sync(db)
+    user = get_cached_user_by_username(username)
+    if user is None:
+        generation = principal_generation
+        db_user = await get_db_user_by_username_async(db, username)
+        if db_user is None:
+            return None
+        user = convert_user_for_api(db_user)
+        if not reads_from_replica(db):
+            cache_user(user, generation)
+    return user
+
+
+def get_cached_user_by_id(user_id: int) -> Optional[User]:
+    return principal_cache.get(("id", user_id))
+
+
+def get_cached_user_by_username(username: str) -> Optional[User]:
+    user_id = principal_cache.get(("username", username))
+    user = None if user_id is None else principal_cache.get(("id", user_id))
+    # the username entry is stale when the user was renamed or invalidated
+    if user is None or user.username != username:
+        return None
+    return user
+
+
+async def batch_get_users_payload(db: AsyncSession, batch: UserBatchGet) -> dict:
+    """
+    Users by ids, usernames and emails, as dicts in the User schema keyed by
+    the requested values, None for values without a user. Cached users are
+    answered without a query, the rest with one IN (...) query per key type.
+    """
+    if (
+        len(batch.ids) + len(batch.usernames) + len(batch.emails)
+        > settings.BATCH_GET_MAX_KEYS
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.BATCH_GET_MAX_KEYS} keys per request",
+        )
+    await user_invalidations.sync(db)
+    result = {}
+    for name, key_column, get_cached in (
+        ("ids", UserTable.id, get_cached_user_by_id),
+        ("usernames", UserTable.username, get_cached_user_by_username),
+        ("emails", UserTable.email, None),
+    ):
+        values = list(dict.fromkeys(getattr(batch, name)))
+        users = {}
+        if get_cached is not None:
+            for value in values:
+                user = get_cached(value)
+                if user is not None:
+                    users[value] = user.model_dump()
+        missing = [value for value in values if value not in users]
+        # fetched users aren't cached, a large batch would evict the
+        # principals of active sessions
+        users.update(await get_users_payload_by(db, key_column, missing))
+        result[name] = {value: users.get(value) for value in values}
+    return result
+
+
+async def get_users_payload_by(db: AsyncSession, column, values: list) -> dict:
+    users = {}
+    for start in range(0, len(values), BULK_CHUNK_SIZE):
+        chunk = values[start : start + BULK_CHUNK_SIZE]
+        with stage(f"db.get_users_by_{column.key}"):
+            result = await db.execute(select(*USER_COLUMNS).where(column.in_(chunk)))
+        for row in result:
+            user = row._asdict()
+            users[user[column.key]] = user
+    return users
+
+
+def cache_user(user: User, generation: int | None = None) -> None:
+    """
+    Cache a user read at the given principal_generation. A read which an
+    invalidation overtook may hold the old row and isn't cached.
+    """
+    with principal_lock:
+        if generation is not None and generation != principal_generation:
+            return
+        principal_cache.set(("id", user.id), user)
+        principal_cache.set(("username", user.username), user.id)
+
+
+def invalidate_user(user_id: int) -> None:
+    global principal_generation
+    with principal_lock:
+        principal_generation += 1
+        # username entries point at the id entry, dropping it is enough
+        principal_cache.pop(("id", user_id))
+
+
+class UserInvalidations:
+    """
+    Users changed by any worker, persisted in the user_invalidations table
+    and synced from it every PRINCIPAL_SYNC_SECONDS, so every worker drops
+    its cached copies. Rows are kept until copies cached before the change
+    have expired anyway.
+    """
+
+    def __init__(self) -> None:
+        self.applied = ExpiringSet()
+        self._last_sync = float("-inf")
+
+    async def sync(self, db: AsyncSession) -> None:
+        if principal_cache.maxsize == 0:
+            return
+        now = time.monotonic()
+        if now - self._last_sync < settings.PRINCIPAL_SYNC_SECONDS:
+            return
+        self._last_sync = now
+        # all live rows like TokenDenylist.sync, ids can commit out of order
+        result = await db.execute(
+            select(
+                UserInvalidationTable.id,
+                UserInvalidationTable.user_id,
+                UserInvalidationTable.expires_at,
+            ).where(UserInvalidationTable.expires_at > time.time())
+        )
+        for row in result:
+            if row.id not in self.applied:
+                self.applied.add(row.id, row.expires_at)
+                invalidate_user(row.user_id)
+
+    def record(self, db: Session, user_id: int) -> None:
+        """
+        Add an invalidation to the caller's transaction, it applies to this
+        worker once committed.
+        """
+        if principal_cache.maxsize == 0:
+            return
+        db.execute(
+            delete(UserInvalidationTable).where(
+                UserInvalidationTable.expires_at <= time.time()
+            )
+        )
+        expires_at = math.ceil(time.time() + settings.PRINCIPAL_CACHE_TTL_SECONDS)
+        result = db.execute(
+            insert(UserInvalidationTable).values(user_id=user_id, expires_at=expires_at)
+        )
+        self.applied.add(result.inserted_primary_key[0], expires_at)
+
+
+user_invalidations = UserInvalidations()
+
+
 def get_db_user_by_id(db: Session, user_id: int) -> UserInDB:
-    return db.query(UserTable).filter(UserTable.id == user_id).first()
+    with stage("db.get_user_by_id"):
+        return db.query(UserTable).filter(UserTable.id == user_id).first()
 
 
 def get_db_user_by_email(db: Session, user_email: EmailStr) -> UserInDB:
-    return db.query(UserTable).filter(UserTable.email == user_email).first()
+    with stage("db.get_user_by_email"):
+        return db.query(UserTable).filter(UserTable.email == user_email).first()
 
 
 def get_db_user_by_username(db: Session, username: str) -> UserInDB:
-    return db.query(UserTable).filter(UserTable.username == username).first()
+    with stage("db.get_user_by_username"):
+        return db.query(UserTable).filter(UserTable.username == username).first()
+
+
+async def get_db_user_by_id_async(db: AsyncSession, user_id: int) -> UserInDB:
+    with stage("db.get_user_by_id"):
+        return await db.scalar(select(UserTable).where(UserTable.id == user_id))
+
+
+async def get_db_user_by_email_async(
+    db: AsyncSession, user_email: EmailStr
+) -> UserInDB:
+    with stage("db.get_user_by_email"):
+        return await db.scalar(select(UserTable).where(UserTable.email == user_email))
+
+
+async def get_db_user_by_username_async(db: AsyncSession, username: str) -> UserInDB:
+    with stage("db.get_user_by_username"):
+        return await db.scalar(select(UserTable).where(UserTable.username == username))
 
 
 def convert_user_for_api(db_user: UserInDB) -> User:
@@ -64,48 +338,243 @@ def convert_user_for_api(db_user: UserInDB) -> User:
     return user
 
 
-def get_all_users(db: Session) -> List[User]:
-    db_users = get_db_users_all(db)
-    if db_users is None:
-        raise HTTPException(status_code=404, detail="User not found")
-    user = convert_users_for_api(db_users)
-    return user
-
-
-def get_db_users_all(db: Session) -> List[UserInDB]:
-    return db.query(UserTable).all()
+async def get_all_users_payload(
+    db: AsyncSession, limit: int | None = None, after_id: int | None = None
+) -> List[dict]:
+    """
+    Users as dicts in the User schema, ready to encode.
+    """
+    result = await db.execute(select_users_page(limit, after_id, USER_COLUMNS))
+    return [row._asdict() for row in result]
+
+
+async def stream_all_users(
+    db: AsyncSession, limit: int | None = None, after_id: int | None = None
+) -> AsyncIterator[bytes]:
+    """
+    Encode users as a JSON array chunk by chunk, so memory use doesn't
+    grow with the size of the users table.
+    """
+    query = select_users_page(limit, after_id, USER_COLUMNS).execution_options(
+        yield_per=STREAM_BATCH_SIZE
+    )
+    result = await db.stream(query)
+    separator = b"["
+    async for rows in result.partitions():
+        # strip the brackets of the encoded array
+        yield separator + orjson.dumps([row._asdict() for row in rows])[1:-1]
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
+async def search_users_payload(
+    db: AsyncSession,
+    q: str | None = None,
+    prefix: bool = False,
+    is_active: bool | None = None,
+    is_superuser: bool | None = None,
+    limit: int = 50,
+    after_id: int | None = None,
+) -> List[dict]:
+    """
+    Users whose username, email or full name contains q, or starts with it,
+    case-insensitively. Ordered by id, as dicts in the User schema.
+    """
+    query = select_users_page(limit, after_id, USER_COLUMNS)
+    if is_active is not None:
+        query = query.where(UserTable.is_active == is_active)
+    if is_superuser is not None:
+        query = query.where(UserTable.is_superuser == is_superuser)
+    if q:
+        if prefix:
+            query = query.where(prefix_condition(q, db.get_bind().dialect.name))
+        else:
+            query = query.where(await contains_condition(db, q))
+    result = await db.execute(query)
+    return [row._asdict() for row in result]
+
+
+def prefix_condition(q: str, dialect_name: str) -> ColumnElement:
+    # lower() folds only ascii on sqlite, and unlike python elsewhere, so other
+    # terms leave the folding to the database
+    if not q.isascii():
+        return or_(*(col.istartswith(q, autoescape=True) for col in SEARCH_COLUMNS))
+    # a range on lower(column) in code point order, which sqlite uses and
+    # postgres with the "C" collation of the ix_users_*_lower_c indexes
+    lower = q.lower()
+    upper = lower[:-1] + chr(ord(lower[-1]) + 1)
+    keys = [func.lower(col) for col in SEARCH_COLUMNS]
+    if dialect_name == "postgresql":
+        keys = [key.collate("C") for key in keys]
+    return or_(*(and_(key >= lower, key < upper) for key in keys))
+
+
+async def contains_condition(db: AsyncSession, q: str) -> ColumnElement:
+    # trigrams need at least 3 characters, shorter terms scan the table.
+    # On postgres the ILIKE below can use the pg_trgm ix_users_*_trgm indexes
+    if len(q) >= 3 and await has_search_table(db):
+        phrase = '"' + q.replace('"', '""') + '"'
+        matches = (
+            text(
+                f"SELECT rowid FROM {USER_SEARCH_TABLE} WHERE {USER_SEARCH_TABLE} MATCH :q"
+            )
+            .bindparams(q=phrase)
+            .columns(column("rowid", Integer))
+        )
+        return UserTable.id.in_(matches)
+    return or_(*(col.icontains(q, autoescape=True) for col in SEARCH_COLUMNS))
+
+
+async def has_search_table(db: AsyncSession) -> bool:
+    bind = db.get_bind()
+    if bind.dialect.name != "sqlite":
+        return False
+    url = str(bind.url)
+    if url not in _search_tables:
+        _search_tables[url] = (
+            await db.scalar(
+                text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                {"name": USER_SEARCH_TABLE},
+            )
+            is not None
+        )
+    return _search_tables[url]
+
+
+async def get_user_stats_payload(db: AsyncSession) -> dict:
+    """
+    User counts from one aggregate query, the table is never loaded.
+    Cached for USER_STATS_CACHE_TTL_SECONDS.
+    """
+    stats = stats_cache.get("users")
+    if stats is None:
+        query = select(
+            func.count().label("total"),
+            func.count(case((UserTable.is_active, 1))).label("active"),
+            func.count(case((UserTable.is_superuser, 1))).label("superusers"),
+        )
+        with stage("db.get_user_stats"):
+            row = (await db.execute(query)).one()
+        stats = row._asdict()
+        stats_cache.set("users", stats)
+    return stats
 
 
-def convert_users_for_api(db_users: List[UserInDB]) -> List[User]:
-    users = []
-    for db_user in db_users:
-        user = convert_user_for_api(db_user)
-        users.append(user)
-    return users
+def select_users_page(
+    limit: int | None, after_id: int | None, columns: tuple = (UserTable,)
+) -> Select:
+    # keyset pagination on the primary key, cheap at any depth
+    query = select(*columns).order_by(UserTable.id)
+    if after_id is not None:
+        query = query.where(UserTable.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
 
 
 def create_user(db: Session, user: UserCreate) -> User:
-    # check if user already exists
-    conflict_user = get_db_user_by_email(db, user_email=user.email)
-    if conflict_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    conflict_user = get_db_user_by_username(db, username=user.username)
-    if conflict_user:
-        raise HTTPException(status_code=400, detail="Username already registered")
-
-    db_user = UserTable(
-        username=user.username,
-        email=user.email,
-        full_name=user.full_name,
-        hashed_password=get_password_hash(user.password),
-        is_active=user.is_active,
-        is_superuser=user.is_superuser,
+    # single INSERT ... RETURNING, the unique constraints catch conflicts
+    query = (
+        insert(UserTable)
+        .values(
+            username=user.username,
+            email=user.email,
+            full_name=user.full_name,
+            hashed_password=hash_password_on_pool(user.password),
+            is_active=user.is_active,
+            is_superuser=user.is_superuser,
+        )
+        .returning(UserTable)
+    )
+    try:
+        created_user = convert_user_for_api(db.scalar(query))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        # only the failure path looks up which value is taken
+        if get_db_user_by_email(db, user_email=user.email):
+            raise HTTPException(status_code=400, detail="Email already registered")
+        if get_db_user_by_username(db, username=user.username):
+            raise HTTPException(status_code=400, detail="Username already registered")
+        raise
+    cache_user(created_user)
+    stats_cache.clear()
+    return created_user
+
+
+def create_users_bulk(db: Session, users: List[UserCreate]) -> List[UserBulkResult]:
+    if len(users) > settings.BULK_CREATE_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.BULK_CREATE_MAX_USERS} users per request",
+        )
+    # one IN (...) query per column instead of two lookups per user
+    taken_emails = get_taken_values(db, UserTable.email, [u.email for u in users])
+    taken_usernames = get_taken_values(
+        db, UserTable.username, [u.username for u in users]
     )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    user = convert_user_for_api(db_user)
-    return user
+
+    results = []
+    accepted = []
+    for index, user in enumerate(users):
+        result = UserBulkResult(index=index, username=user.username, status="created")
+        if user.email in taken_emails:
+            result.status, result.detail = "conflict", "Email already registered"
+        elif user.username in taken_usernames:
+            result.status, result.detail = "conflict", "Username already registered"
+        else:
+            # later duplicates within the same request conflict with this one
+            taken_emails.add(user.email)
+            taken_usernames.add(user.username)
+            accepted.append((result, user))
+        results.append(result)
+
+    hashed_passwords = get_password_hashes(user.password for _, user in accepted)
+    rows = [
+        dict(
+            username=user.username,
+            email=user.email,
+            full_name=user.full_name,
+            hashed_password=hashed_password,
+            is_active=user.is_active,
+            is_superuser=user.is_superuser,
+        )
+        for (_, user), hashed_password in zip(accepted, hashed_passwords)
+    ]
+    db_users = []
+    try:
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            db_users.extend(
+                db.scalars(
+                    insert(UserTable).returning(
+                        UserTable, sort_by_parameter_order=True
+                    ),
+                    rows[start : start + BULK_CHUNK_SIZE],
+                )
+            )
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail="Users were registered concurrently, please retry",
+        )
+
+    # not cached like in create_user, thousands of new users would evict the
+    # principals of active sessions, a first login loads them
+    for (result, _), db_user in zip(accepted, db_users):
+        result.user = convert_user_for_api(db_user)
+    if db_users:
+        stats_cache.clear()
+    return results
+
+
+def get_taken_values(db: Session, column, values: List[str]) -> set:
+    taken = set()
+    for start in range(0, len(values), BULK_CHUNK_SIZE):
+        chunk = values[start : start + BULK_CHUNK_SIZE]
+        taken.update(db.scalars(select(column).where(column.in_(chunk))))
+    return taken
 
 
 def create_default_superuser(db: Session) -> User:
@@ -121,48 +590,60 @@ def create_default_superuser(db: Session) -> User:
 
 
 def update_user(db: Session, user_id: int, user: UserUpdate) -> User:
-    db_user = get_db_user_by_id(db, user_id)
-    if db_user is None:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    # if allow to update username
-    if user.username is not None and user.username != db_user.username:
-        conflict_user = get_db_user_by_username(db, user.username)
-        if conflict_user is not None:
-            raise HTTPException(
-                status_code=404, detail="User with same username already exists"
-            )
-        db_user.username = user.username
-
-    # if allow to update email
-    if user.email is not None and user.email != db_user.email:
-        conflict_user = get_db_user_by_email(db, user.email)
-        if conflict_user is not None:
-            raise HTTPException(
-                status_code=404, detail="User with same email already exists"
-            )
-        db_user.email = user.email
-
-    if user.full_name is not None and user.full_name != db_user.full_name:
-        db_user.full_name = user.full_name
+    values = user.model_dump(exclude={"password"}, exclude_none=True)
     if user.password is not None:
-        db_user.hashed_password = get_password_hash(user.password)
-    if user.is_active is not None and user.is_active != db_user.is_active:
-        db_user.is_active = user.is_active
-    if user.is_superuser is not None and user.is_superuser != db_user.is_superuser:
-        db_user.is_superuser = user.is_superuser
-    db.commit()
-    db.refresh(db_user)
-    updated_user = convert_user_for_api(db_user)
+        values["hashed_password"] = hash_password_on_pool(user.password)
+    if not values:
+        db_user = get_db_user_by_id(db, user_id)
+        if db_user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return convert_user_for_api(db_user)
+
+    # single UPDATE ... RETURNING, the unique constraints catch conflicts
+    query = (
+        update(UserTable)
+        .where(UserTable.id == user_id)
+        .values(**values)
+        .returning(UserTable)
+    )
+    try:
+        db_user = db.scalar(query)
+        if db_user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        updated_user = convert_user_for_api(db_user)
+        user_invalidations.record(db, user_id)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        # only the failure path looks up which value is taken
+        if user.username is not None:
+            conflict_user = get_db_user_by_username(db, user.username)
+            if conflict_user is not None and conflict_user.id != user_id:
+                raise HTTPException(
+                    status_code=404, detail="User with same username already exists"
+                )
+        if user.email is not None:
+            conflict_user = get_db_user_by_email(db, user.email)
+            if conflict_user is not None and conflict_user.id != user_id:
+                raise HTTPException(
+                    status_code=404, detail="User with same email already exists"
+                )
+        raise
+    # not refreshed, a concurrent update may have committed after this one
+    invalidate_user(user_id)
+    stats_cache.clear()
     return updated_user
 
 
 def delete_user(db: Session, user_id: int) -> UserDelete:
-    db_user = get_db_user_by_id(db, user_id)
+    # single DELETE ... RETURNING
+    query = delete(UserTable).where(UserTable.id == user_id).returning(UserTable)
+    db_user = db.scalar(query)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    db.delete(db_user)
-    db.commit()
+    # in the same transaction, without relying on the foreign key cascade
+    db.execute(delete(RefreshTokenTable).where(RefreshTokenTable.user_id == user_id))
+    user_invalidations.record(db, user_id)
     deleted_user = UserDelete(
         username=db_user.username,
         email=db_user.email,
@@ -171,64 +652,262 @@ def delete_user(db: Session, user_id: int) -> UserDelete:
         is_superuser=db_user.is_superuser,
         status="deleted",
     )
+    db.commit()
+    invalidate_user(user_id)
+    stats_cache.clear()
     return deleted_user
 
 
 # authentications
 
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
-    db_user = get_db_user_by_username(db, username)
+async def authenticate_user(
+    db: AsyncSession, username: str, password: str
+) -> Optional[User]:
+    db_user = await get_db_user_by_username_async(db, username)
     if not db_user:
         return None
-    if not verify_password(password, db_user.hashed_password):
+    valid, new_hash = await verify_and_update_password_async(
+        password, db_user.hashed_password
+    )
+    if not valid:
         return None
+    if new_hash is not None:
+        await db.execute(rehash_query(db_user, new_hash))
+        await db.commit()
     return db_user
 
 
-def get_current_user(
-    db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
-) -> User:
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
+def rehash_query(db_user: UserInDB, new_hash: str) -> Update:
+    # skip the upgrade if the password was changed in the meantime
+    return (
+        update(UserTable)
+        .where(
+            UserTable.id == db_user.id,
+            UserTable.hashed_password == db_user.hashed_password,
+        )
+        .values(hashed_password=new_hash)
+        .execution_options(synchronize_session=False)
     )
-    try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]
-        )
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    db_user = get_db_user_by_username(db, username=token_data.username)
-    if db_user is None:
-        raise credentials_exception
-    user = convert_user_for_api(db_user)
+
+
+CREDENTIALS_EXCEPTION = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+
+def decode_access_token(token: str) -> TokenData:
+    cache_key = hashlib.sha256(token.encode()).digest()
+    token_data = token_cache.get(cache_key)
+    if token_data is None:
+        try:
+            with stage("jwt.decode"):
+                payload = key_ring.decode(token)
+        except JWTError:
+            raise CREDENTIALS_EXCEPTION
+        if payload.get("sub") is None:
+            raise CREDENTIALS_EXCEPTION
+        token_data = TokenData(
+            username=payload["sub"],
+            user_id=payload.get("uid"),
+            scopes=payload.get("scp", 0),
+            jti=payload.get("jti"),
+            expires_at=payload.get("exp"),
+        )
+        token_cache.set(cache_key, token_data, expires_at=payload.get("exp"))
+    return token_data
+
+
+async def verify_access_token(db: AsyncSession, token: str) -> TokenData:
+    """
+    Decode the token and check that it hasn't been revoked.
+    """
+    token_data = decode_access_token(token)
+    await denylist.sync(db)
+    if token_data.jti is not None and token_data.jti in denylist:
+        raise CREDENTIALS_EXCEPTION
+    return token_data
+
+
+async def get_current_user(
+    db: AsyncSession = Depends(get_read_db), token: str = Depends(oauth2_scheme)
+) -> User:
+    token_data = await verify_access_token(db, token)
+    user = await get_user_by_username(db, token_data.username)
+    if user is None:
+        raise CREDENTIALS_EXCEPTION
     return user
 
 
+async def get_current_principal(
+    db: AsyncSession = Depends(get_read_db), token: str = Depends(oauth2_scheme)
+) -> TokenData:
+    """
+    The caller's identity and scopes. In STATELESS_AUTH mode they come from
+    the token claims alone, otherwise from the current state of the user.
+    """
+    if settings.STATELESS_AUTH:
+        return await verify_access_token(db, token)
+    user = await get_current_user(db, token)
+    return TokenData(
+        username=user.username,
+        user_id=user.id,
+        scopes=get_scopes(user.is_active, user.is_superuser),
+    )
+
+
+def require_scopes(scopes: Scope) -> Callable:
+    """
+    Dependency that requires an active caller holding all the given scopes.
+    """
+
+    async def check_scopes(
+        principal: TokenData = Depends(get_current_principal),
+    ) -> TokenData:
+        if not principal.scopes & Scope.ACTIVE:
+            raise HTTPException(status_code=400, detail="Inactive user")
+        if scopes & ~principal.scopes:
+            raise HTTPException(
+                status_code=400, detail="The user doesn't have enough privileges"
+            )
+        return principal
+
+    return check_scopes
+
+
 def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
 
-def get_current_active_superuser(
-    current_user: User = Depends(get_current_active_user),
-) -> User:
-    if not current_user.is_superuser:
-        raise HTTPException(
-            status_code=400, detail="The user doesn't have enough privileges"
+get_current_active_principal = require_scopes(Scope.ACTIVE)
+get_current_active_superuser = require_scopes(Scope.SUPERUSER)
+
+
+def check_login_rate(username: str, client_host: str | None) -> None:
+    """
+    Raise 429 when the username or the client has no login attempts left.
+    """
+    for name, key in (("username", username), ("client", client_host)):
+        if key is None:
+            continue
+        retry_after = login_limiters[name].acquire(key)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts, try again later",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+
+async def create_token(
+    db: AsyncSession,
+    form_data: OAuth2PasswordRequestForm,
+    client_host: str | None = None,
+) -> Token:
+    # throttle before bcrypt runs, rejected attempts cost no hashing
+    if login_bucket_store.blocking:
+        await run_in_threadpool(check_login_rate, form_data.username, client_host)
+    else:
+        check_login_rate(form_data.username, client_host)
+    db_user = await authenticate_user(db, form_data.username, form_data.password)
+    token = issue_token(db_user)
+    token.refresh_token, row = new_refresh_token(db_user.id)
+    await store_refresh_token(db, row)
+    await db.commit()
+    return token
+
+
+async def refresh_token(db: AsyncSession, refresh_token: str) -> Token:
+    """
+    Exchange a refresh token for new access and refresh tokens.
+    Each refresh token can be used once, presenting a used one again revokes
+    every token rotated from the same login.
+    """
+    refresh_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    token_hash = hash_refresh_token(refresh_token)
+    # mark used and read in one statement, so a token can't be rotated twice
+    result = await db.execute(
+        update(RefreshTokenTable)
+        .where(
+            RefreshTokenTable.token_hash == token_hash,
+            RefreshTokenTable.used.is_(False),
         )
-    return current_user
+        .values(used=True)
+        .returning(
+            RefreshTokenTable.user_id,
+            RefreshTokenTable.family_id,
+            RefreshTokenTable.expires_at,
+        )
+    )
+    row = result.first()
+    if row is None:
+        family_id = await db.scalar(
+            select(RefreshTokenTable.family_id).where(
+                RefreshTokenTable.token_hash == token_hash
+            )
+        )
+        if family_id is not None:
+            # reuse of a rotated token, it was probably stolen
+            await db.execute(
+                update(RefreshTokenTable)
+                .where(RefreshTokenTable.family_id == family_id)
+                .values(used=True)
+            )
+            await db.commit()
+        raise refresh_exception
+    user = await get_user_by_id(db, row.user_id)
+    if row.expires_at <= time.time() or user is None or not user.is_active:
+        await db.commit()
+        raise refresh_exception
+
+    token = issue_token(user)
+    token.refresh_token, new_row = new_refresh_token(user.id, row.family_id)
+    await store_refresh_token(db, new_row)
+    await db.commit()
+    return token
+
+
+async def store_refresh_token(db: AsyncSession, row: dict) -> None:
+    # expired tokens can't be redeemed, drop them as new ones are issued
+    await db.execute(
+        delete(RefreshTokenTable).where(RefreshTokenTable.expires_at <= time.time())
+    )
+    await db.execute(insert(RefreshTokenTable).values(**row))
+
+
+async def logout(
+    db: AsyncSession, token: str, refresh_token: str | None = None
+) -> None:
+    """
+    Revoke the access token until it expires, and with the refresh token,
+    every refresh token rotated from the same login.
+    """
+    token_data = await verify_access_token(db, token)
+    if token_data.jti is None or token_data.expires_at is None:
+        raise HTTPException(status_code=400, detail="Token can't be revoked")
+    if refresh_token is not None:
+        family = select(RefreshTokenTable.family_id).where(
+            RefreshTokenTable.token_hash == hash_refresh_token(refresh_token),
+            RefreshTokenTable.user_id == token_data.user_id,
+        )
+        await db.execute(
+            update(RefreshTokenTable)
+            .where(RefreshTokenTable.family_id.in_(family.scalar_subquery()))
+            .values(used=True)
+        )
+        await db.commit()
+    await denylist.revoke(db, token_data.jti, token_data.expires_at)
 
 
-def create_token(db: Session, form_data: OAuth2PasswordRequestForm) -> Token:
-    db_user = authenticate_user(db, form_data.username, form_data.password)
+def issue_token(db_user: Optional[UserInDB]) -> Token:
     if db_user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -241,9 +920,15 @@ def create_token(db: Session, form_data: OAuth2PasswordRequestForm) -> Token:
             detail="Inactive user",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    if settings.STATELESS_AUTH:
+        expire_minutes = settings.STATELESS_ACCESS_TOKEN_EXPIRE_MINUTES
+    else:
+        expire_minutes = settings.ACCESS_TOKEN_EXPIRE_MINUTES
+    access_token_expires = timedelta(minutes=expire_minutes)
+    scopes = get_scopes(db_user.is_active, db_user.is_superuser)
     access_token = create_access_token(
-        data={"sub": db_user.username}, expires_delta=access_token_expires
+        data={"sub": db_user.username, "uid": db_user.id, "scp": int(scopes)},
+        expires_delta=access_token_expires,
     )
     token = Token(access_token=access_token, token_type="bearer")
     return token
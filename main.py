@@ -1,13 +1,36 @@
+from contextlib import asynccontextmanager
+
+from config import settings
+from controllers.token import check_shared_keys, hashing_executor
 from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
-from routers import users
-from utils.database import Base, engine
+from routers import keys, metrics, users
+from utils.database import QueryCountMiddleware, close_db, init_db
+from utils.metrics import MetricsMiddleware, TimedJSONResponse
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    check_shared_keys()
+    # importing the app doesn't touch the database, startup does
+    await init_db()
+    yield
+    hashing_executor.shutdown()
+    await close_db()
 
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI(debug=True)
+app = FastAPI(
+    debug=settings.DEBUG,
+    default_response_class=TimedJSONResponse,
+    lifespan=lifespan,
+)
 
 app.include_router(users.router)
+app.include_router(keys.router)
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics.router)
+app.add_middleware(QueryCountMiddleware, headers=settings.DEBUG)
 
 
 def custom_openapi():
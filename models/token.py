@@ -0,0 +1,23 @@
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, LargeBinary, String
+from utils.database import Base
+
+
+class RefreshTokenTable(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # sha256 digest of the opaque token, the token itself is never stored
+    token_hash = Column(LargeBinary(32), unique=True, index=True)
+    # tokens rotated from the same login share a family
+    family_id = Column(String(32), index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    expires_at = Column(Integer, index=True)
+    used = Column(Boolean, default=False)
+
+
+class RevokedTokenTable(Base):
+    __tablename__ = "revoked_tokens"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    jti = Column(String(32), unique=True, index=True)
+    expires_at = Column(Integer, index=True)
@@ -1,6 +1,47 @@
-from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy import Boolean, Column, Index, Integer, String, event, func
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.schema import CreateIndex
 from utils.database import Base
 
+# sqlite FTS5 trigram index over the searchable columns, kept in sync with
+# the users table by triggers, for substring search
+USER_SEARCH_TABLE = "users_search"
+USER_SEARCH_DDL = [
+    f"CREATE VIRTUAL TABLE {USER_SEARCH_TABLE} USING fts5("
+    "username, email, full_name, content='users', content_rowid='id', "
+    "tokenize='trigram')",
+    f"CREATE TRIGGER {USER_SEARCH_TABLE}_ai AFTER INSERT ON users BEGIN "
+    f"INSERT INTO {USER_SEARCH_TABLE}(rowid, username, email, full_name) "
+    "VALUES (new.id, new.username, new.email, new.full_name); END",
+    f"CREATE TRIGGER {USER_SEARCH_TABLE}_ad AFTER DELETE ON users BEGIN "
+    f"INSERT INTO {USER_SEARCH_TABLE}"
+    f"({USER_SEARCH_TABLE}, rowid, username, email, full_name) "
+    "VALUES ('delete', old.id, old.username, old.email, old.full_name); END",
+    f"CREATE TRIGGER {USER_SEARCH_TABLE}_au "
+    "AFTER UPDATE OF username, email, full_name ON users BEGIN "
+    f"INSERT INTO {USER_SEARCH_TABLE}"
+    f"({USER_SEARCH_TABLE}, rowid, username, email, full_name) "
+    "VALUES ('delete', old.id, old.username, old.email, old.full_name); "
+    f"INSERT INTO {USER_SEARCH_TABLE}(rowid, username, email, full_name) "
+    "VALUES (new.id, new.username, new.email, new.full_name); END",
+    # index the rows which existed before the table
+    f"INSERT INTO {USER_SEARCH_TABLE}({USER_SEARCH_TABLE}) VALUES ('rebuild')",
+]
+USER_SEARCH_COLUMNS = ("username", "email", "full_name")
+# postgres: byte-ordered lower() indexes for the prefix ranges, which the
+# default collation would order differently, and pg_trgm indexes for
+# substring ILIKE
+USER_PREFIX_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_users_{name}_lower_c "
+    f'ON users ((lower({name}) COLLATE "C"))'
+    for name in USER_SEARCH_COLUMNS
+]
+USER_TRIGRAM_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_users_{name}_trgm "
+    f"ON users USING gin ({name} gin_trgm_ops)"
+    for name in USER_SEARCH_COLUMNS
+]
+
 
 class UserTable(Base):
     __tablename__ = "users"
@@ -12,3 +53,68 @@ class UserTable(Base):
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
     is_superuser = Column(Boolean, default=False)
+
+    __table_args__ = (
+        # filtered listings, ordered by id for keyset pagination
+        Index("ix_users_is_active_is_superuser_id", is_active, is_superuser, id),
+        Index("ix_users_is_superuser_id", is_superuser, id),
+        # case-insensitive prefix search
+        Index("ix_users_username_lower", func.lower(username)),
+        Index("ix_users_email_lower", func.lower(email)),
+        Index("ix_users_full_name_lower", func.lower(full_name)),
+        # never reuse the id of a deleted user, tokens and caches refer to it
+        {"sqlite_autoincrement": True},
+    )
+
+
+class UserInvalidationTable(Base):
+    __tablename__ = "user_invalidations"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, index=True)
+    # once cached copies read before the change have expired
+    expires_at = Column(Integer, index=True)
+
+    # never reuse an id, workers remember the ids they have applied
+    __table_args__ = ({"sqlite_autoincrement": True},)
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_user_search_indexes(target, connection, **kw) -> None:
+    """
+    Add the indexes to an existing users table too, the postgres search
+    indexes, and the sqlite search table where FTS5 with the trigram
+    tokenizer is available.
+    """
+    for index in UserTable.__table__.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+    if connection.dialect.name == "postgresql":
+        create_postgres_search_indexes(connection)
+    if connection.dialect.name != "sqlite":
+        return
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = ?", (USER_SEARCH_TABLE,)
+    ).first()
+    if exists:
+        return
+    try:
+        connection.exec_driver_sql(USER_SEARCH_DDL[0])
+    except OperationalError:
+        # sqlite older than 3.34 or built without FTS5, search uses LIKE
+        return
+    for statement in USER_SEARCH_DDL[1:]:
+        connection.exec_driver_sql(statement)
+
+
+def create_postgres_search_indexes(connection) -> None:
+    for statement in USER_PREFIX_DDL:
+        connection.exec_driver_sql(statement)
+    try:
+        # in a savepoint, a failure would abort the whole transaction
+        with connection.begin_nested():
+            connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DBAPIError:
+        # no privilege to create the extension, search scans with ILIKE
+        return
+    for statement in USER_TRIGRAM_DDL:
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,13 @@
+from controllers import token as token_ctrl
+from fastapi import APIRouter, Request, Response
+
+router = APIRouter(tags=["keys"])
+
+
+@router.get("/.well-known/jwks.json")
+def get_jwks(request: Request) -> Response:
+    """
+    Public keys to verify access tokens locally, select by the kid header.
+    Empty for HS* algorithms, whose secret is never published.
+    """
+    return token_ctrl.get_jwks(request)
@@ -0,0 +1,13 @@
+from controllers import metrics as metrics_ctrl
+from fastapi import APIRouter, Response
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """
+    Metrics in the Prometheus text format.
+    Async, so the threadpool gauges are read from the event loop.
+    """
+    return metrics_ctrl.get_metrics()
@@ -1,18 +1,31 @@
 from typing import List
 
 from controllers import user as user_ctrl
-from fastapi import APIRouter, Depends
+from controllers.token import oauth2_scheme
+from fastapi import APIRouter, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import EmailStr
-from schemas.token import Token
-from schemas.user import User, UserCreate, UserDelete, UserUpdate
+from schemas.token import Token, TokenData, TokenRefresh
+from schemas.user import (
+    User,
+    UserBatchGet,
+    UserBatchResult,
+    UserBulkResult,
+    UserCreate,
+    UserDelete,
+    UserStats,
+    UserUpdate,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from utils.database import get_db
+from utils.database import get_async_db, get_db, get_read_db, pin_reads_to_primary
+from utils.metrics import TimedJSONResponse
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 
-@router.post("/init", response_model=User)
+@router.post("/init", response_model=User, dependencies=[Depends(pin_reads_to_primary)])
 def create_default_superuser(db: Session = Depends(get_db)) -> User:
     """
     Create the default superuser. Run this once when deploy a new app.
@@ -21,57 +34,170 @@ def create_default_superuser(db: Session = Depends(get_db)) -> User:
 
 
 @router.post("/token", response_model=Token)
-def login_for_access_token(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
+async def login_for_access_token(
+    request: Request,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: AsyncSession = Depends(get_async_db),
 ) -> Token:
     """
     OAuth2 login, return access token.
+    Attempts are rate limited per username and per client address.
+    Password verification runs on the dedicated hashing pool.
     """
-    return user_ctrl.create_token(db, form_data)
+    client_host = request.client.host if request.client else None
+    return await user_ctrl.create_token(db, form_data, client_host)
+
+
+@router.post("/token/refresh", response_model=Token)
+async def refresh_access_token(
+    body: TokenRefresh, db: AsyncSession = Depends(get_async_db)
+) -> Token:
+    """
+    Exchange a refresh token for new access and refresh tokens.
+    The refresh token is rotated, it can be used only once.
+    """
+    return await user_ctrl.refresh_token(db, body.refresh_token)
+
+
+@router.post("/logout", status_code=204)
+async def logout(
+    body: TokenRefresh | None = None,
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_db),
+) -> Response:
+    """
+    Revoke the current access token.
+    Pass the refresh token of the session to revoke it too.
+    """
+    refresh_token = None if body is None else body.refresh_token
+    await user_ctrl.logout(db, token, refresh_token)
+    return Response(status_code=204)
 
 
 @router.get("/me", response_model=User)
-def get_users_me(
+async def get_users_me(
     current_user: User = Depends(user_ctrl.get_current_active_user),
 ) -> User:
     """
     Get current user details.
     """
-    return current_user
+    # returning a response skips validating the user against User again
+    return TimedJSONResponse(current_user.model_dump())
 
 
 @router.get("/", response_model=User)
-def get_user(
+async def get_user(
     user_id: int | None = None,
     username: str | None = None,
     email: EmailStr | None = None,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(user_ctrl.get_current_active_superuser),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
 ) -> User:
     """
     Get user details by email.
     Require superuser privilege
     """
-    return user_ctrl.get_user(db, user_id, username, email)
+    user = await user_ctrl.get_user(db, user_id, username, email)
+    return TimedJSONResponse(user.model_dump())
 
 
 @router.get("/all", response_model=List[User])
-def get_all_users(
-    db: Session = Depends(get_db),
-    current_user: User = Depends(user_ctrl.get_current_active_superuser),
+async def get_all_users(
+    request: Request,
+    limit: int | None = Query(None, ge=1, le=1000),
+    after_id: int | None = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
 ) -> List[User]:
     """
-    Get all users details.
+    Get all users details, ordered by id.
+    Pass limit and after_id to page through users, the id to continue from
+    is returned in the X-Next-After-Id and Link headers.
+    Pass stream=true to stream the JSON array instead of building it in memory.
     Require superuser privilege
     """
-    return user_ctrl.get_all_users(db)
+    if stream:
+        return StreamingResponse(
+            user_ctrl.stream_all_users(db, limit, after_id),
+            media_type="application/json",
+        )
+    # plain rows encoded by orjson, response_model only documents the schema
+    users = await user_ctrl.get_all_users_payload(db, limit, after_id)
+    return paginated_response(request, users, limit)
 
 
-@router.post("/", response_model=User)
+@router.get("/search", response_model=List[User])
+async def search_users(
+    request: Request,
+    q: str | None = Query(None, min_length=1, max_length=50),
+    prefix: bool = False,
+    is_active: bool | None = None,
+    is_superuser: bool | None = None,
+    limit: int = Query(50, ge=1, le=1000),
+    after_id: int | None = None,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
+) -> List[User]:
+    """
+    Search users by username, email or full name, case-insensitively.
+    q matches anywhere in the value, or only at its start with prefix=true.
+    Filter by is_active and is_superuser, page with limit and after_id like
+    /users/all.
+    Require superuser privilege
+    """
+    users = await user_ctrl.search_users_payload(
+        db, q, prefix, is_active, is_superuser, limit, after_id
+    )
+    return paginated_response(request, users, limit)
+
+
+@router.get("/stats", response_model=UserStats)
+async def get_user_stats(
+    db: AsyncSession = Depends(get_read_db),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
+) -> UserStats:
+    """
+    Get the number of users, active users and superusers.
+    Require superuser privilege
+    """
+    stats = await user_ctrl.get_user_stats_payload(db)
+    return TimedJSONResponse(stats)
+
+
+@router.post("/batch-get", response_model=UserBatchResult)
+async def batch_get_users(
+    batch: UserBatchGet,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
+) -> UserBatchResult:
+    """
+    Get many users by ids, usernames and emails in one request.
+    Each map is keyed by the requested values, null when no user matches.
+    Require superuser privilege
+    """
+    users = await user_ctrl.batch_get_users_payload(db, batch)
+    return TimedJSONResponse(users)
+
+
+def paginated_response(
+    request: Request, users: List[dict], limit: int | None
+) -> TimedJSONResponse:
+    # a full page may have more users after it
+    response = TimedJSONResponse(users)
+    if limit is not None and len(users) == limit:
+        next_after_id = users[-1]["id"]
+        next_url = request.url.include_query_params(after_id=next_after_id)
+        response.headers["X-Next-After-Id"] = str(next_after_id)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+@router.post("/", response_model=User, dependencies=[Depends(pin_reads_to_primary)])
 def create_user(
     user: UserCreate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(user_ctrl.get_current_active_superuser),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
 ) -> User:
     """
     Create new user.
@@ -80,12 +206,31 @@ def create_user(
     return user_ctrl.create_user(db, user)
 
 
-@router.put("/{user_id}", response_model=User)
+@router.post(
+    "/bulk",
+    response_model=List[UserBulkResult],
+    dependencies=[Depends(pin_reads_to_primary)],
+)
+def create_users_bulk(
+    users: List[UserCreate],
+    db: Session = Depends(get_db),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
+) -> List[UserBulkResult]:
+    """
+    Create many users in one transaction, report the outcome of each item.
+    Require superuser privilege
+    """
+    return user_ctrl.create_users_bulk(db, users)
+
+
+@router.put(
+    "/{user_id}", response_model=User, dependencies=[Depends(pin_reads_to_primary)]
+)
 def update_user(
     user_id: int,
     user_update: UserUpdate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(user_ctrl.get_current_active_superuser),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
 ) -> User:
     """
     Update user details (full_name, password, is_active, is_superuser) by email.
@@ -94,11 +239,15 @@ def update_user(
     return user_ctrl.update_user(db, user_id, user_update)
 
 
-@router.delete("/{user_id}", response_model=UserDelete)
+@router.delete(
+    "/{user_id}",
+    response_model=UserDelete,
+    dependencies=[Depends(pin_reads_to_primary)],
+)
 def delete_user(
     user_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(user_ctrl.get_current_active_superuser),
+    current_user: TokenData = Depends(user_ctrl.get_current_active_superuser),
 ) -> UserDelete:
     """
     Delete user by email.
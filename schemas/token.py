@@ -4,7 +4,17 @@ from pydantic import BaseModel
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
+
+
+class TokenRefresh(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
     username: str | None = None
+    user_id: int | None = None
+    # bitmask of controllers.token.Scope
+    scopes: int = 0
+    jti: str | None = None
+    expires_at: int | None = None
@@ -38,3 +38,30 @@ class User(UserInDBBase):
 # Additional properties stored in DB
 class UserInDB(User):
     hashed_password: str
+
+
+class UserBulkResult(BaseModel):
+    index: int
+    username: str
+    status: str
+    detail: str | None = None
+    user: User | None = None
+
+
+class UserBatchGet(BaseModel):
+    ids: list[int] = []
+    usernames: list[str] = []
+    emails: list[str] = []
+
+
+class UserBatchResult(BaseModel):
+    # keyed by the requested values, null when no user matches
+    ids: dict[int, User | None] = {}
+    usernames: dict[str, User | None] = {}
+    emails: dict[str, User | None] = {}
+
+
+class UserStats(BaseModel):
+    total: int
+    active: int
+    superusers: int
@@ -1,17 +1,40 @@
 import os
+from contextlib import contextmanager
 
 import pytest
 from fastapi.testclient import TestClient
 
 # set ENV before create the app, to make sure we are creating a test db
 os.environ["ENV"] = "TEST"
+# the tests log in far more often than a person would
+os.environ["LOGIN_USERNAME_BURST"] = "1000"
+os.environ["LOGIN_CLIENT_BURST"] = "1000"
+# cheapest bcrypt cost, the tests don't need slow hashes
+os.environ["BCRYPT_ROUNDS"] = "4"
 from main import app  # noqa: E402
+from utils.database import count_queries  # noqa: E402
 
 
 @pytest.fixture(scope="session")
 def test_app():
-    client = TestClient(app)
-    yield client
+    # entering the client runs the startup, which creates the tables
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def assert_max_queries():
+    """
+    with assert_max_queries(3): ... fails if the block runs more statements.
+    """
+
+    @contextmanager
+    def check(limit: int):
+        with count_queries() as stats:
+            yield stats
+        assert stats.count <= limit, f"{stats.count} queries, at most {limit} allowed"
+
+    return check
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -19,7 +42,9 @@ def clear_db_teardown():
     # code before yield statement will execute before the first test
     yield None
     # code after yield statement will execute after the last test
-    os.remove("fastapi_app_test.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(f"fastapi_app_test.db{suffix}"):
+            os.remove(f"fastapi_app_test.db{suffix}")
 
 
 # @pytest.fixture(scope="session")
@@ -0,0 +1,57 @@
+import time
+
+from utils.cache import ExpiringSet, TTLCache
+
+
+def test_cache_hit_and_miss():
+    cache = TTLCache(maxsize=2)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_ratio == 0.5
+
+
+def test_cache_lru_eviction():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # touch "a" so that "b" becomes the least recently used entry
+    cache.get("a")
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_cache_expiry():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1, expires_at=time.time() - 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+
+
+def test_cache_disabled():
+    cache = TTLCache(maxsize=0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_expiring_set():
+    revoked = ExpiringSet()
+    revoked.add("live", time.time() + 60)
+    revoked.add("expired", time.time() - 1)
+    assert "live" in revoked
+    assert "expired" not in revoked
+
+    revoked.add("soon", time.time() + 0.01)
+    assert len(revoked) == 2
+    time.sleep(0.02)
+    assert "soon" not in revoked
+    assert len(revoked) == 1
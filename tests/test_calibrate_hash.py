@@ -0,0 +1,12 @@
+from utils.calibrate_hash import write_env
+
+
+def test_write_env(tmp_path):
+    env_file = tmp_path / ".env"
+    env_file.write_text("SECRET_KEY=abc\nBCRYPT_ROUNDS=10\n")
+    write_env(env_file, {"PASSWORD_HASH_SCHEME": "bcrypt", "BCRYPT_ROUNDS": 12})
+    assert env_file.read_text().splitlines() == [
+        "SECRET_KEY=abc",
+        "PASSWORD_HASH_SCHEME=bcrypt",
+        "BCRYPT_ROUNDS=12",
+    ]
@@ -0,0 +1,25 @@
+import threading
+
+import pytest
+from utils.executor import BoundedExecutor, ExecutorOverloaded
+
+
+def test_bounded_executor_rejects_when_full():
+    executor = BoundedExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    running = [executor.submit(release.wait), executor.submit(release.wait)]
+    with pytest.raises(ExecutorOverloaded):
+        executor.submit(release.wait)
+
+    release.set()
+    for future in running:
+        future.result(timeout=5)
+    assert executor.submit(lambda: 42, block=True).result(timeout=5) == 42
+    executor.shutdown()
+
+
+def test_bounded_executor_usable_after_shutdown():
+    executor = BoundedExecutor(max_workers=1, max_queue=1)
+    executor.shutdown()
+    assert executor.submit(lambda: 42).result(timeout=5) == 42
+    executor.shutdown()
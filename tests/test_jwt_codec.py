@@ -0,0 +1,68 @@
+import time
+
+import pytest
+from jose import ExpiredSignatureError, JWTError, jwt
+from utils.jwt_codec import HMACCodec, JoseCodec, PyJWTCodec, get_codec
+
+SECRET = "secret"
+
+
+def test_get_codec():
+    assert isinstance(get_codec("auto", "HS256"), HMACCodec)
+    assert isinstance(get_codec("auto", "RS256"), JoseCodec)
+    with pytest.raises(ValueError):
+        get_codec("builtin", "RS256")
+    with pytest.raises(ValueError):
+        get_codec("unknown", "HS256")
+    with pytest.raises(ValueError):
+        get_codec("jose", "EdDSA")
+
+
+def test_get_codec_eddsa():
+    try:
+        import jwt  # noqa: F401
+    except ImportError:
+        with pytest.raises(ValueError, match="-E pyjwt"):
+            get_codec("auto", "EdDSA")
+    else:
+        assert isinstance(get_codec("auto", "EdDSA"), PyJWTCodec)
+
+
+@pytest.mark.parametrize("algorithm", ["HS256", "HS512"])
+def test_hmac_codec_compatible_with_jose(algorithm):
+    codec = HMACCodec(algorithm)
+    key, _ = codec.prepare_keys(SECRET)
+    claims = {"sub": "someone", "exp": int(time.time()) + 60}
+
+    token = codec.encode(claims, key)
+    assert token == jwt.encode(claims, SECRET, algorithm=algorithm)
+    assert jwt.decode(token, SECRET, algorithms=[algorithm]) == claims
+
+    token = jwt.encode(claims, SECRET, algorithm=algorithm, headers={"kid": "1"})
+    assert codec.decode(token, key) == claims
+
+
+def test_hmac_codec_rejects_invalid_tokens():
+    codec = HMACCodec("HS256")
+    key, _ = codec.prepare_keys(SECRET)
+    token = codec.encode({"sub": "someone"}, key)
+
+    other_key, _ = codec.prepare_keys("other")
+    with pytest.raises(JWTError):
+        codec.decode(token, other_key)
+    with pytest.raises(JWTError):
+        codec.decode(token[:-2], key)
+    with pytest.raises(JWTError):
+        codec.decode("not a token", key)
+    # same secret, another algorithm
+    with pytest.raises(JWTError):
+        codec.decode(jwt.encode({"sub": "someone"}, SECRET, "HS384"), key)
+
+
+def test_hmac_codec_validates_time_claims():
+    codec = HMACCodec("HS256")
+    key, _ = codec.prepare_keys(SECRET)
+    with pytest.raises(ExpiredSignatureError):
+        codec.decode(codec.encode({"exp": int(time.time()) - 1}, key), key)
+    with pytest.raises(JWTError):
+        codec.decode(codec.encode({"nbf": int(time.time()) + 60}, key), key)
@@ -0,0 +1,170 @@
+import json
+
+import pytest
+from config import settings
+from controllers.token import check_shared_keys
+from jose import JWTError, jwt
+from utils.keys import KeyRing, generate_private_key
+
+
+@pytest.mark.parametrize("algorithm", ["RS256", "ES256"])
+def test_key_ring_rotation(algorithm):
+    key_ring = KeyRing(algorithm, secret_key="", retention_minutes=30)
+    token = key_ring.encode({"sub": "someone"})
+    old_kid = key_ring.signing_key().kid
+
+    key_ring.rotate()
+    new_token = key_ring.encode({"sub": "someone"})
+    assert key_ring.signing_key().kid != old_kid
+    # tokens signed by the retired key still verify
+    assert key_ring.decode(token) == {"sub": "someone"}
+    assert key_ring.decode(new_token) == {"sub": "someone"}
+
+    content, _ = key_ring.jwks()
+    kids = {key["kid"] for key in json.loads(content)["keys"]}
+    assert kids == {old_kid, key_ring.signing_key().kid}
+
+
+def test_key_ring_publishes_before_signing():
+    key_ring = KeyRing("ES256", secret_key="", retention_minutes=30, publish_seconds=60)
+    old_kid = key_ring.signing_key().kid
+    key_ring.rotate()
+    new_kid = key_ring._next_key.kid
+    # published at once, signing only after verifiers could refresh the JWKS
+    content, _ = key_ring.jwks()
+    assert {key["kid"] for key in json.loads(content)["keys"]} == {old_kid, new_kid}
+    assert key_ring.signing_key().kid == old_kid
+
+    key_ring._next_key.active_at -= 60
+    token = key_ring.encode({"sub": "someone"})
+    assert jwt.get_unverified_header(token)["kid"] == new_kid
+    assert key_ring.decode(token) == {"sub": "someone"}
+
+
+def test_key_ring_retired_key_expires():
+    key_ring = KeyRing("ES256", secret_key="", retention_minutes=0)
+    token = key_ring.encode({"sub": "someone"})
+    key_ring.rotate()
+    with pytest.raises(JWTError):
+        key_ring.decode(token)
+
+
+def test_key_ring_symmetric():
+    key_ring = KeyRing("HS256", secret_key="secret")
+    token = key_ring.encode({"sub": "someone"})
+    assert key_ring.decode(token) == {"sub": "someone"}
+    assert json.loads(key_ring.jwks()[0]) == {"keys": []}
+    with pytest.raises(JWTError):
+        KeyRing("HS256", secret_key="other").decode(token)
+
+
+def test_get_jwks(test_app):
+    response = test_app.get("/.well-known/jwks.json")
+    assert response.status_code == 200
+    assert "max-age" in response.headers["Cache-Control"]
+
+    response = test_app.get(
+        "/.well-known/jwks.json",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert response.status_code == 304
+
+
+def test_key_ring_secret_file_reload(tmp_path):
+    secret_file = tmp_path / "secret"
+    secret_file.write_text("first secret\n")
+    key_ring = KeyRing(
+        "HS256",
+        secret_key="",
+        retention_minutes=30,
+        secret_key_file=str(secret_file),
+        reload_seconds=0,
+    )
+    # another worker reading the same file accepts the token
+    other_worker = KeyRing("HS256", secret_key="", secret_key_file=str(secret_file))
+    token = key_ring.encode({"sub": "someone"})
+    assert other_worker.decode(token) == {"sub": "someone"}
+
+    secret_file.write_text("second secret, a little longer\n")
+    new_token = key_ring.encode({"sub": "someone"})
+    assert jwt.get_unverified_header(new_token)["kid"] != (
+        jwt.get_unverified_header(token)["kid"]
+    )
+    # tokens signed with the previous secret verify until they expire
+    assert key_ring.decode(token) == {"sub": "someone"}
+    assert key_ring.decode(new_token) == {"sub": "someone"}
+    with pytest.raises(JWTError):
+        other_worker.decode(new_token)
+
+    # a broken file keeps the current secret
+    secret_file.write_text("")
+    assert key_ring.decode(key_ring.encode({"sub": "someone"})) == {"sub": "someone"}
+
+
+def test_key_ring_keys_dir_reload(tmp_path):
+    (tmp_path / "a.pem").write_text(generate_private_key("ES256"))
+    key_ring = KeyRing("ES256", secret_key="", keys_dir=str(tmp_path), reload_seconds=0)
+    first_key = key_ring.signing_key()
+    assert first_key.kid == "a"
+
+    (tmp_path / "b.pem").write_text(generate_private_key("ES256"))
+    assert key_ring.signing_key().kid == "b"
+    # unchanged files are not parsed again
+    assert key_ring._keys["a"] is first_key
+
+
+def test_key_ring_keys_dir_publish_and_remove(tmp_path):
+    (tmp_path / "a.pem").write_text(generate_private_key("ES256"))
+    key_ring = KeyRing(
+        "ES256",
+        secret_key="",
+        keys_dir=str(tmp_path),
+        retention_minutes=30,
+        reload_seconds=0,
+        publish_seconds=60,
+    )
+    token = key_ring.encode({"sub": "someone"})
+
+    # a new file is published first
+    (tmp_path / "b.pem").write_text(generate_private_key("ES256"))
+    assert key_ring.signing_key().kid == "a"
+    assert {key["kid"] for key in json.loads(key_ring.jwks()[0])["keys"]} == {
+        "a",
+        "b",
+    }
+    key_ring._next_key.active_at -= 60
+    assert key_ring.signing_key().kid == "b"
+
+    # a removed file keeps verifying for the retention window
+    (tmp_path / "a.pem").unlink()
+    assert key_ring.signing_key().kid == "b"
+    assert key_ring.decode(token) == {"sub": "someone"}
+    key_ring._keys["a"].retired_at -= 31 * 60
+    (tmp_path / "c.pem").write_text(generate_private_key("ES256"))
+    key_ring.signing_key()
+    with pytest.raises(JWTError):
+        key_ring.decode(token)
+
+
+def test_check_shared_keys(monkeypatch):
+    monkeypatch.setattr(settings, "WEB_CONCURRENCY", 2)
+    monkeypatch.setattr(settings, "SECRET_KEY_FILE", None)
+    monkeypatch.setattr(settings, "ALGORITHM", "HS256")
+    with pytest.raises(RuntimeError):
+        check_shared_keys()
+    monkeypatch.setattr(settings, "SECRET_KEY_FILE", "/run/secrets/jwt")
+    check_shared_keys()
+
+
+def test_check_shared_keys_in_production(monkeypatch):
+    # uvicorn --workers and several pods don't set WEB_CONCURRENCY
+    monkeypatch.setattr(settings, "WEB_CONCURRENCY", 1)
+    monkeypatch.setattr(settings, "SECRET_KEY_FILE", None)
+    monkeypatch.setattr(settings, "ALGORITHM", "ES256")
+    monkeypatch.setattr(settings, "JWT_KEYS_DIR", None)
+    check_shared_keys()
+    monkeypatch.setattr(settings, "ENV", "PROD")
+    with pytest.raises(RuntimeError):
+        check_shared_keys()
+    monkeypatch.setattr(settings, "JWT_KEYS_DIR", "/run/secrets/jwt-keys")
+    check_shared_keys()
@@ -0,0 +1,40 @@
+from utils.metrics import Registry
+
+
+def test_render_counter_and_gauge():
+    registry = Registry()
+    counter = registry.counter("calls_total", "Calls.", labels=("kind",))
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    registry.gauge("ratio", "Ratio.", callback=lambda: {(): 0.5})
+    assert registry.render().decode() == (
+        "# HELP calls_total Calls.\n"
+        "# TYPE calls_total counter\n"
+        'calls_total{kind="a"} 3\n'
+        "# HELP ratio Ratio.\n"
+        "# TYPE ratio gauge\n"
+        "ratio 0.5\n"
+    )
+
+
+def test_render_histogram():
+    registry = Registry()
+    histogram = registry.histogram("latency", "Latency.", buckets=(0.1, 1.0))
+    histogram.observe(value=0.1)
+    histogram.observe(value=0.5)
+    histogram.observe(value=2.0)
+    assert histogram.count() == 3
+    lines = registry.render().decode().splitlines()[2:]
+    assert lines == [
+        'latency_bucket{le="0.1"} 1',
+        'latency_bucket{le="1.0"} 2',
+        'latency_bucket{le="+Inf"} 3',
+        "latency_sum 2.6",
+        "latency_count 3",
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.counter("c", "C.", labels=("path",)).inc('a"b\\')
+    assert 'c{path="a\\"b\\\\"} 1' in registry.render().decode()
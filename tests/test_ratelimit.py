@@ -0,0 +1,31 @@
+import pytest
+from utils.ratelimit import MemoryBucketStore, SQLiteBucketStore, take_token
+
+
+def test_take_token():
+    assert take_token(2, 0, rate=1, burst=2, now=0) == (1, 0)
+    assert take_token(0, 0, rate=0.5, burst=2, now=0) == (0, 2)
+    # refills with time, up to the burst
+    assert take_token(0, 0, rate=1, burst=2, now=100) == (1, 0)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteBucketStore(str(tmp_path / "buckets.db"), prune_every=1)
+    return MemoryBucketStore(max_keys=2)
+
+
+def test_bucket_store(store):
+    assert store.take("a", rate=1, burst=1, now=0) == 0
+    assert store.take("a", rate=1, burst=1, now=0.5) == 0.5
+    assert store.take("a", rate=1, burst=1, now=1) == 0
+    # buckets are independent per key
+    assert store.take("b", rate=1, burst=1, now=1) == 0
+
+
+def test_memory_bucket_store_evicts():
+    store = MemoryBucketStore(max_keys=2)
+    for key in "abc":
+        store.take(key, rate=1, burst=1, now=0)
+    assert len(store) == 2
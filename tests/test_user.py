@@ -1,4 +1,27 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
 from config import settings
+from controllers import token as token_ctrl
+from controllers import user as user_ctrl
+from controllers.token import Scope, TokenDenylist
+from controllers.user import token_cache
+from fastapi.testclient import TestClient
+from jose import jwt
+from main import app
+from models.token import RefreshTokenTable, RevokedTokenTable
+from models.user import UserTable
+from passlib.hash import bcrypt
+from schemas.user import User, UserUpdate
+from sqlalchemy import delete, event, insert, select, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from utils import database
+from utils.database import SessionLocal, count_queries, create_replica_engine
+from utils.ratelimit import MemoryBucketStore, TokenBucketLimiter
 
 DEFAULT_SUPER_USER = {
     "id": 1,
@@ -71,12 +94,98 @@ def super_user_login(test_app):
     )
 
 
+def test_login_rate_limit(test_app, monkeypatch):
+    limiter = TokenBucketLimiter(
+        "username", rate=0.01, burst=2, store=MemoryBucketStore(max_keys=10)
+    )
+    monkeypatch.setitem(user_ctrl.login_limiters, "username", limiter)
+    login_data = {"username": "nobody", "password": "wrong"}
+    for _ in range(2):
+        response = test_app.post("/users/token", data=login_data)
+        assert response.status_code == 401
+    response = test_app.post("/users/token", data=login_data)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+
 def test_create_access_token(test_app):
     r = super_user_login(test_app)
     assert "access_token" in r
     assert r["token_type"] == "bearer"
 
 
+def test_refresh_access_token(test_app):
+    refresh_token = super_user_login(test_app)["refresh_token"]
+    response = test_app.post(
+        "/users/token/refresh", json={"refresh_token": refresh_token}
+    )
+    assert response.status_code == 200
+    token = response.json()
+    assert token["refresh_token"] != refresh_token
+    response = test_app.get(
+        "/users/me", headers={"Authorization": f"Bearer {token['access_token']}"}
+    )
+    assert response.json() == DEFAULT_SUPER_USER
+
+    # reusing a rotated token revokes the whole family
+    for used_token in (refresh_token, token["refresh_token"]):
+        response = test_app.post(
+            "/users/token/refresh", json={"refresh_token": used_token}
+        )
+        assert response.status_code == 401
+        assert response.json() == {"detail": "Invalid refresh token"}
+
+
+def test_expired_refresh_tokens_pruned(test_app):
+    with SessionLocal() as db:
+        db.execute(
+            insert(RefreshTokenTable).values(
+                token_hash=b"x" * 32, family_id="expired", user_id=1, expires_at=1
+            )
+        )
+        db.commit()
+    super_user_login(test_app)
+    with SessionLocal() as db:
+        assert (
+            db.scalar(
+                select(RefreshTokenTable).where(
+                    RefreshTokenTable.family_id == "expired"
+                )
+            )
+            is None
+        )
+
+
+def test_logout(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    assert test_app.get("/users/me", headers=headers).status_code == 200
+
+    response = test_app.post("/users/logout", headers=headers)
+    assert response.status_code == 204
+    for _ in range(2):
+        response = test_app.get("/users/me", headers=headers)
+        assert response.status_code == 401
+    assert test_app.post("/users/logout", headers=headers).status_code == 401
+
+    # with the refresh token, the refresh tokens of the login are revoked too
+    token = super_user_login(test_app)
+    headers = {"Authorization": f"Bearer {token['access_token']}"}
+    refreshed = test_app.post(
+        "/users/token/refresh", json={"refresh_token": token["refresh_token"]}
+    ).json()
+    response = test_app.post(
+        "/users/logout",
+        headers=headers,
+        json={"refresh_token": refreshed["refresh_token"]},
+    )
+    assert response.status_code == 204
+    response = test_app.post(
+        "/users/token/refresh", json={"refresh_token": refreshed["refresh_token"]}
+    )
+    assert response.status_code == 401
+
+
 def test_get_user_me(test_app):
     access_token = super_user_login(test_app)["access_token"]
     response = test_app.get(
@@ -87,6 +196,19 @@ def test_get_user_me(test_app):
     assert response.json() == DEFAULT_SUPER_USER
 
 
+def test_get_user_me_token_cache(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    token_cache.clear()
+    hits = token_cache.hits
+    for _ in range(2):
+        response = test_app.get(
+            "/users/me", headers={"Authorization": f"Bearer {access_token}"}
+        )
+        assert response.status_code == 200
+        assert response.json() == DEFAULT_SUPER_USER
+    assert token_cache.hits == hits + 1
+
+
 def test_create_normal_user(test_app):
     access_token = super_user_login(test_app)["access_token"]
     test_data = TEST_USER_1.copy()
@@ -209,6 +331,71 @@ def test_get_user_by_username_superuser(test_app):
     assert response.json() == DEFAULT_SUPER_USER
 
 
+def test_stateless_auth(test_app, monkeypatch):
+    monkeypatch.setattr(settings, "STATELESS_AUTH", True)
+    access_token = super_user_login(test_app)["access_token"]
+    claims = jwt.get_unverified_claims(access_token)
+    assert claims["uid"] == DEFAULT_SUPER_USER["id"]
+    assert claims["scp"] == Scope.ACTIVE | Scope.SUPERUSER
+    response = test_app.get(
+        "/users/all", headers={"Authorization": f"Bearer {access_token}"}
+    )
+    assert response.status_code == 200
+
+    access_token = login(test_app, TEST_USER_1["username"], TEST_USER_1_PASSWORD)[
+        "access_token"
+    ]
+    assert jwt.get_unverified_claims(access_token)["scp"] == Scope.ACTIVE
+    response = test_app.get(
+        "/users/all", headers={"Authorization": f"Bearer {access_token}"}
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "The user doesn't have enough privileges"}
+
+
+def test_update_user_invalidates_principal_cache(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    user_2_token = login(test_app, TEST_USER_2["username"], TEST_USER_2_PASSWORD)[
+        "access_token"
+    ]
+    response = test_app.get(
+        "/users/me", headers={"Authorization": f"Bearer {user_2_token}"}
+    )
+    assert response.json() == TEST_USER_2
+
+    for is_superuser in (False, True):
+        response = test_app.put(
+            f"/users/{TEST_USER_2['id']}",
+            headers={"Authorization": f"Bearer {access_token}"},
+            json={"is_superuser": is_superuser},
+        )
+        assert response.status_code == 200
+        response = test_app.get(
+            "/users/me", headers={"Authorization": f"Bearer {user_2_token}"}
+        )
+        assert response.json()["is_superuser"] is is_superuser
+
+
+def test_update_user_conflict(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    for field in ("username", "email"):
+        response = test_app.put(
+            f"/users/{TEST_USER_2['id']}",
+            headers={"Authorization": f"Bearer {access_token}"},
+            json={field: DEFAULT_SUPER_USER[field], "is_superuser": True},
+        )
+        assert response.status_code == 404
+        assert response.json() == {"detail": f"User with same {field} already exists"}
+
+    response = test_app.put(
+        "/users/999",
+        headers={"Authorization": f"Bearer {access_token}"},
+        json={"full_name": "Nobody"},
+    )
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User not found"}
+
+
 def test_update_user_normal_user(test_app):
     """
     TODO:
@@ -293,6 +480,49 @@ def test_get_user_all_super_user(test_app):
     assert response.json() == test_data
 
 
+def test_get_user_all_paginated(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = test_app.get("/users/all", headers=headers, params={"limit": 2})
+    assert response.status_code == 200
+    assert response.json() == [DEFAULT_SUPER_USER, TEST_USER_1_NEW]
+    assert response.headers["X-Next-After-Id"] == str(TEST_USER_1_NEW["id"])
+
+    response = test_app.get(
+        "/users/all",
+        headers=headers,
+        params={"limit": 2, "after_id": response.headers["X-Next-After-Id"]},
+    )
+    assert response.status_code == 200
+    assert response.json() == [TEST_USER_2]
+    assert "X-Next-After-Id" not in response.headers
+
+
+def test_get_user_all_streamed(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = test_app.get("/users/all", headers=headers, params={"stream": True})
+    assert response.status_code == 200
+    assert response.json() == [DEFAULT_SUPER_USER, TEST_USER_1_NEW, TEST_USER_2]
+
+    response = test_app.get(
+        "/users/all",
+        headers=headers,
+        params={"stream": True, "after_id": TEST_USER_2["id"]},
+    )
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_get_user_all_matches_schema(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = test_app.get("/users/all", headers=headers)
+    assert [list(user) for user in response.json()] == [list(User.model_fields)] * 3
+    streamed = test_app.get("/users/all", headers=headers, params={"stream": True})
+    assert streamed.content == response.content
+
+
 def test_delete_user_normal_user(test_app):
     """can a user delete itself?"""
     access_token = login(
@@ -339,3 +569,529 @@ def test_get_user_all_again(test_app):
     )
     assert response.status_code == 200
     assert response.json() == [DEFAULT_SUPER_USER]
+
+
+def test_create_users_bulk(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    new_users = [
+        {
+            "username": f"bulkuser{i}",
+            "email": f"bulk.user{i}@example.com",
+            "full_name": f"Bulk User{i}",
+            "password": "bulkpass",
+        }
+        for i in range(3)
+    ]
+    # conflicts with an existing user and with an earlier item
+    new_users[1]["username"] = DEFAULT_SUPER_USER["username"]
+    new_users[2]["email"] = new_users[0]["email"]
+
+    response = test_app.post(
+        "/users/bulk",
+        headers={"Authorization": f"Bearer {access_token}"},
+        json=new_users,
+    )
+    assert response.status_code == 200
+    results = response.json()
+    assert [r["status"] for r in results] == ["created", "conflict", "conflict"]
+    assert results[0]["user"]["username"] == "bulkuser0"
+    assert user_ctrl.get_cached_user_by_id(results[0]["user"]["id"]) is None
+    assert results[1]["detail"] == "Username already registered"
+    assert results[2]["detail"] == "Email already registered"
+    login(test_app, "bulkuser0", "bulkpass")
+
+
+def test_rehash_on_login(test_app):
+    old_hash = bcrypt.using(rounds=5).hash("bulkpass")
+    with SessionLocal() as db:
+        db.execute(
+            update(UserTable)
+            .where(UserTable.username == "bulkuser0")
+            .values(hashed_password=old_hash)
+        )
+        db.commit()
+
+    login(test_app, "bulkuser0", "bulkpass")
+    with SessionLocal() as db:
+        new_hash = db.scalar(
+            select(UserTable.hashed_password).where(UserTable.username == "bulkuser0")
+        )
+    assert new_hash != old_hash
+    assert new_hash.startswith(f"$2b${settings.BCRYPT_ROUNDS:02d}$")
+    login(test_app, "bulkuser0", "bulkpass")
+
+
+def test_metrics(test_app):
+    login(test_app, "bulkuser0", "bulkpass")
+    response = test_app.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    metrics = response.text
+    assert (
+        'http_request_duration_seconds_count{method="POST",'
+        'route="/users/token",status="200"}'
+    ) in metrics
+    for stage in ("password.verify", "jwt.encode", "db.get_user_by_username"):
+        assert f'app_stage_duration_seconds_count{{stage="{stage}"}}' in metrics
+    assert 'cache_hit_ratio{cache="token"}' in metrics
+    assert 'db_pool_connections_checked_out{engine="sync"}' in metrics
+    assert 'threadpool_threads_busy{pool="anyio"}' in metrics
+
+
+def test_update_user_query_count(test_app, assert_max_queries):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    user_id = test_app.get(
+        "/users/", headers=headers, params={"username": "bulkuser0"}
+    ).json()["id"]
+    # denylist sync and user lookup when not cached, then UPDATE ... RETURNING
+    with assert_max_queries(3) as stats:
+        response = test_app.put(
+            f"/users/{user_id}",
+            headers=headers,
+            json={"full_name": "Bulk User Renamed"},
+        )
+    assert response.status_code == 200
+    assert response.headers["X-DB-Query-Count"] == str(stats.count)
+    assert float(response.headers["X-DB-Query-Time-ms"]) >= 0
+
+
+def test_read_replica(test_app, monkeypatch, tmp_path):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {"email": "bulk.user0@example.com"}
+    # the replica starts as a copy of the primary
+    replica_path = tmp_path / "replica.db"
+    with closing(sqlite3.connect("fastapi_app_test.db")) as primary, closing(
+        sqlite3.connect(replica_path)
+    ) as replica:
+        primary.backup(replica)
+    replica_engine = create_replica_engine(f"sqlite:///{replica_path}")
+    monkeypatch.setattr(
+        database,
+        "ReplicaSessionLocals",
+        [async_sessionmaker(bind=replica_engine, expire_on_commit=False)],
+    )
+    replica_name = test_app.get("/users/", headers=headers, params=params).json()[
+        "full_name"
+    ]
+
+    # a write the replica hasn't received
+    with SessionLocal() as db:
+        db.execute(
+            update(UserTable)
+            .where(UserTable.username == "bulkuser0")
+            .values(full_name="Primary Name")
+        )
+        db.commit()
+    response = test_app.get("/users/", headers=headers, params=params)
+    assert response.json()["full_name"] == replica_name
+
+    # the client's own writes are read back from the primary
+    response = test_app.put(
+        f"/users/{response.json()['id']}",
+        headers=headers,
+        json={"full_name": "Written Name"},
+    )
+    assert response.status_code == 200
+    assert database.PRIMARY_COOKIE in response.cookies
+    response = test_app.get("/users/", headers=headers, params=params)
+    assert response.json()["full_name"] == "Written Name"
+
+    test_app.cookies.clear()
+    response = test_app.get("/users/", headers=headers, params=params)
+    assert response.json()["full_name"] == replica_name
+
+
+def test_search_users(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    new_users = [
+        {
+            "username": f"searchuser{i}",
+            "email": f"search.user{i}@example.com",
+            "full_name": f"Finder {i}",
+            "password": "searchpass",
+        }
+        for i in range(3)
+    ]
+    response = test_app.post("/users/bulk", headers=headers, json=new_users)
+    assert [r["status"] for r in response.json()] == ["created"] * 3
+    search_ids = [r["user"]["id"] for r in response.json()]
+
+    def search(**params):
+        response = test_app.get("/users/search", headers=headers, params=params)
+        assert response.status_code == 200
+        return response
+
+    def usernames(response):
+        return [user["username"] for user in response.json()]
+
+    # substring through the trigram index, and shorter than a trigram
+    assert usernames(search(q="ARCHUSER")) == [u["username"] for u in new_users]
+    assert usernames(search(q="r 1")) == ["searchuser1"]
+    assert usernames(search(q="user1@")) == ["searchuser1"]
+    assert usernames(search(q="%")) == []
+    # prefix matches only at the start of a value
+    assert usernames(search(q="fInDeR", prefix=True)) == usernames(search(q="finder"))
+    assert usernames(search(q="archuser", prefix=True)) == []
+    assert usernames(search(q="search.user2", prefix=True)) == ["searchuser2"]
+    # filters and keyset pagination
+    assert usernames(search(is_superuser=True)) == [DEFAULT_SUPER_USER["username"]]
+    assert usernames(search(q="search", is_superuser=True)) == []
+    response = search(q="search", limit=2)
+    assert usernames(response) == ["searchuser0", "searchuser1"]
+    assert response.headers["X-Next-After-Id"] == str(search_ids[1])
+    response = search(q="search", limit=2, after_id=search_ids[1])
+    assert usernames(response) == ["searchuser2"]
+    assert "Link" not in response.headers
+
+    # the search index follows updates and deletes
+    test_app.put(
+        f"/users/{search_ids[2]}",
+        headers=headers,
+        json={"full_name": "Renamed Person", "is_active": False},
+    )
+    assert usernames(search(q="renamed")) == ["searchuser2"]
+    assert usernames(search(q="finder")) == ["searchuser0", "searchuser1"]
+    assert usernames(search(q="search", is_active=False)) == ["searchuser2"]
+    test_app.delete(f"/users/{search_ids[2]}", headers=headers)
+    assert usernames(search(q="renamed")) == []
+
+    response = test_app.get("/users/search", headers=headers, params={"q": ""})
+    assert response.status_code == 422
+    normal_token = login(test_app, "searchuser0", "searchpass")["access_token"]
+    response = test_app.get(
+        "/users/search", headers={"Authorization": f"Bearer {normal_token}"}
+    )
+    assert response.status_code == 400
+
+
+def test_batch_get_users(test_app, monkeypatch):
+    # no denylist or principal refresh between the measured requests
+    monkeypatch.setattr(settings, "DENYLIST_SYNC_SECONDS", 3600)
+    monkeypatch.setattr(settings, "PRINCIPAL_SYNC_SECONDS", 3600)
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    users = test_app.get("/users/search", headers=headers, params={"q": "user"}).json()
+    bulk_user = next(user for user in users if user["username"] == "bulkuser0")
+
+    def batch_get(**batch):
+        with count_queries() as stats:
+            response = test_app.post("/users/batch-get", headers=headers, json=batch)
+        assert response.status_code == 200
+        return response.json(), stats.count
+
+    result, _ = batch_get(
+        ids=[bulk_user["id"], 1, 99999, 1],
+        usernames=["bulkuser0", "nobody"],
+        emails=[bulk_user["email"], "nobody@example.com"],
+    )
+    assert result == {
+        "ids": {
+            str(bulk_user["id"]): bulk_user,
+            "1": DEFAULT_SUPER_USER,
+            "99999": None,
+        },
+        "usernames": {"bulkuser0": bulk_user, "nobody": None},
+        "emails": {bulk_user["email"]: bulk_user, "nobody@example.com": None},
+    }
+
+    # the caller is in the principal cache, other users need one query
+    # per chunk of values
+    _, cached_count = batch_get(ids=[1], usernames=[DEFAULT_SUPER_USER["username"]])
+    assert cached_count == 0
+    monkeypatch.setattr(user_ctrl, "BULK_CHUNK_SIZE", 2)
+    ids = [user["id"] for user in users] + list(range(99995, 100000))
+    uncached = [i for i in ids if user_ctrl.get_cached_user_by_id(i) is None]
+    assert len(uncached) > 2
+    result, count = batch_get(ids=ids)
+    assert [user["username"] for user in result["ids"].values() if user] == [
+        user["username"] for user in users
+    ]
+    assert count == -(-len(uncached) // 2)
+
+    monkeypatch.setattr(settings, "BATCH_GET_MAX_KEYS", 2)
+    response = test_app.post(
+        "/users/batch-get", headers=headers, json={"ids": [1], "emails": ["a", "b"]}
+    )
+    assert response.status_code == 400
+
+
+def test_user_stats(test_app, monkeypatch):
+    monkeypatch.setattr(settings, "DENYLIST_SYNC_SECONDS", 3600)
+    monkeypatch.setattr(settings, "PRINCIPAL_SYNC_SECONDS", 3600)
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    def get_stats():
+        with count_queries() as stats:
+            response = test_app.get("/users/stats", headers=headers)
+        assert response.status_code == 200
+        return response.json(), stats.count
+
+    users = test_app.get("/users/all", headers=headers).json()
+    stats, _ = get_stats()
+    assert stats == {
+        "total": len(users),
+        "active": sum(user["is_active"] for user in users),
+        "superusers": sum(user["is_superuser"] for user in users),
+    }
+    # cached until a write
+    assert get_stats() == (stats, 0)
+
+    response = test_app.post(
+        "/users/",
+        headers=headers,
+        json={
+            "username": "statsuser",
+            "email": "stats.user@example.com",
+            "password": "statspass",
+            "is_superuser": True,
+        },
+    )
+    user_id = response.json()["id"]
+    stats, count = get_stats()
+    assert count == 1
+    assert stats["total"] == len(users) + 1
+    assert stats["superusers"] == sum(user["is_superuser"] for user in users) + 1
+
+    test_app.put(f"/users/{user_id}", headers=headers, json={"is_active": False})
+    assert get_stats()[0]["active"] == stats["active"] - 1
+    test_app.delete(f"/users/{user_id}", headers=headers)
+    assert get_stats()[0]["total"] == len(users)
+
+    normal_token = login(test_app, "searchuser0", "searchpass")["access_token"]
+    response = test_app.get(
+        "/users/stats", headers={"Authorization": f"Bearer {normal_token}"}
+    )
+    assert response.status_code == 400
+
+
+def test_refresh_token_of_deleted_user(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    new_user = {
+        "username": "deleteduser",
+        "email": "deleted.user@example.com",
+        "password": "deletedpass",
+    }
+    user_id = test_app.post("/users/", headers=headers, json=new_user).json()["id"]
+    refresh_token = login(test_app, "deleteduser", "deletedpass")["refresh_token"]
+    test_app.delete(f"/users/{user_id}", headers=headers)
+    with SessionLocal() as db:
+        assert not db.scalar(
+            select(RefreshTokenTable).where(RefreshTokenTable.user_id == user_id)
+        )
+
+    # the id of a deleted user isn't given to the next one
+    response = test_app.post(
+        "/users/",
+        headers=headers,
+        json={
+            "username": "nextuser",
+            "email": "next.user@example.com",
+            "password": "nextpass",
+            "is_superuser": True,
+        },
+    )
+    assert response.json()["id"] > user_id
+    response = test_app.post(
+        "/users/token/refresh", json={"refresh_token": refresh_token}
+    )
+    assert response.status_code == 401
+
+
+def test_denylist_sync_between_workers(test_app, monkeypatch):
+    monkeypatch.setattr(settings, "DENYLIST_SYNC_SECONDS", 0)
+    engine = create_async_engine("sqlite+aiosqlite:///fastapi_app_test.db")
+    sessions = async_sessionmaker(bind=engine, expire_on_commit=False)
+    worker_a, worker_b = TokenDenylist(), TokenDenylist()
+
+    async def run():
+        async with sessions() as db:
+            await db.execute(delete(RevokedTokenTable))
+            await db.commit()
+            await worker_a.revoke(db, "t1", int(time.time()) + 1)
+            await worker_b.sync(db)
+            assert "t1" in worker_b
+            # t1 is purged, t2 takes its id
+            await db.execute(
+                update(RevokedTokenTable).values(expires_at=int(time.time()) - 1)
+            )
+            await db.commit()
+            await worker_a.revoke(db, "t2", int(time.time()) + 60)
+            await worker_b.sync(db)
+            assert "t2" in worker_b
+        await engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_principal_invalidation_between_workers(test_app, monkeypatch):
+    monkeypatch.setattr(settings, "PRINCIPAL_SYNC_SECONDS", 0)
+    engine = create_async_engine("sqlite+aiosqlite:///fastapi_app_test.db")
+
+    async def get_user():
+        async with async_sessionmaker(bind=engine)() as db:
+            return await user_ctrl.get_user_by_username(db, "bulkuser0")
+
+    async def run():
+        cached_user = await get_user()
+        # another worker, with its own cache, updates the user
+        with SessionLocal() as db:
+            db.execute(
+                update(UserTable)
+                .where(UserTable.id == cached_user.id)
+                .values(full_name="Other Worker")
+            )
+            user_ctrl.UserInvalidations().record(db, cached_user.id)
+            db.commit()
+        user = await get_user()
+        await engine.dispose()
+        return user
+
+    assert asyncio.run(run()).full_name == "Other Worker"
+
+
+def test_async_engine_reuses_connections(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    connects = []
+
+    def listener(dbapi_connection, connection_record):
+        connects.append(dbapi_connection)
+
+    event.listen(database.async_engine.sync_engine, "connect", listener)
+    try:
+        for _ in range(20):
+            response = test_app.get("/users/all", headers=headers)
+            assert response.status_code == 200
+    finally:
+        event.remove(database.async_engine.sync_engine, "connect", listener)
+    assert len(connects) <= 1
+
+
+def test_write_paths_hash_on_hashing_pool(test_app, monkeypatch):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    threads = []
+    get_password_hash = token_ctrl.get_password_hash
+
+    def record_thread(password):
+        threads.append(threading.current_thread().name)
+        return get_password_hash(password)
+
+    monkeypatch.setattr(token_ctrl, "get_password_hash", record_thread)
+    response = test_app.post(
+        "/users/",
+        headers=headers,
+        json={
+            "username": "pooluser",
+            "email": "pool.user@example.com",
+            "password": "poolpass",
+        },
+    )
+    test_app.put(
+        f"/users/{response.json()['id']}",
+        headers=headers,
+        json={"password": "newpoolpass"},
+    )
+    login(test_app, "pooluser", "newpoolpass")
+    assert len(threads) == 2
+    assert all(name.startswith("password-hashing") for name in threads)
+
+
+def test_principal_cache_skips_reads_overtaken_by_writes(test_app, monkeypatch):
+    get_db_user = user_ctrl.get_db_user_by_username_async
+
+    async def read_then_update(db, username):
+        db_user = await get_db_user(db, username)
+        # an update commits and invalidates while the read is in flight
+        with SessionLocal() as write_db:
+            user_ctrl.update_user(
+                write_db, db_user.id, UserUpdate(full_name="Updated Meanwhile")
+            )
+        return db_user
+
+    monkeypatch.setattr(user_ctrl, "get_db_user_by_username_async", read_then_update)
+    engine = create_async_engine("sqlite+aiosqlite:///fastapi_app_test.db")
+
+    async def run():
+        async with async_sessionmaker(bind=engine)() as db:
+            user = await user_ctrl.get_user_by_username(db, "bulkuser0")
+        await engine.dispose()
+        return user
+
+    with SessionLocal() as db:
+        user_id = db.scalar(
+            select(UserTable.id).where(UserTable.username == "bulkuser0")
+        )
+        user_ctrl.update_user(db, user_id, UserUpdate(full_name="Read Name"))
+    stale_user = asyncio.run(run())
+    assert stale_user.full_name == "Read Name"
+    assert user_ctrl.get_cached_user_by_username("bulkuser0") is None
+
+
+def test_principal_cache_skips_replica_reads(test_app, tmp_path):
+    replica_path = tmp_path / "replica.db"
+    with closing(sqlite3.connect("fastapi_app_test.db")) as primary, closing(
+        sqlite3.connect(replica_path)
+    ) as replica:
+        primary.backup(replica)
+    replica_engine = create_replica_engine(f"sqlite:///{replica_path}")
+    # the update and its invalidation haven't reached the replica yet
+    with SessionLocal() as db:
+        user_id = db.scalar(
+            select(UserTable.id).where(UserTable.username == "bulkuser0")
+        )
+        user_ctrl.update_user(db, user_id, UserUpdate(full_name="Primary Name"))
+
+    async def run():
+        async with async_sessionmaker(bind=replica_engine)() as db:
+            user = await user_ctrl.get_user_by_username(db, "bulkuser0")
+        await replica_engine.dispose()
+        return user
+
+    assert asyncio.run(run()).full_name != "Primary Name"
+    assert user_ctrl.get_cached_user_by_username("bulkuser0") is None
+
+
+def test_search_prefix_non_ascii(test_app):
+    access_token = super_user_login(test_app)["access_token"]
+    headers = {"Authorization": f"Bearer {access_token}"}
+    new_user = {
+        "username": "zolauser",
+        "email": "zola.user@example.com",
+        "full_name": "\u00c9mile Zola",
+        "password": "zolapass",
+    }
+    response = test_app.post("/users/", headers=headers, json=new_user)
+    assert response.status_code == 200
+
+    def search(q, prefix):
+        response = test_app.get(
+            "/users/search", headers=headers, params={"q": q, "prefix": prefix}
+        )
+        assert response.status_code == 200
+        return [user["username"] for user in response.json()]
+
+    # sqlite folds only ascii, the term must not be folded differently
+    assert search("\u00c9mi", prefix=True) == search("\u00c9mi", prefix=False)
+    assert search("\u00c9mi", prefix=True) == ["zolauser"]
+    # the code point after U+D7FF would be a surrogate
+    assert search("Zola\ud7ff", prefix=True) == []
+
+
+def test_search_prefix_range_on_postgres():
+    # the default collation would put "éclair" between "e" and "f"
+    condition = user_ctrl.prefix_condition("E", "postgresql")
+    sql = str(condition.compile(dialect=postgresql.dialect()))
+    assert sql.count('COLLATE "C"') == 6
+
+
+def test_login_after_app_restart(test_app):
+    # the lifespan shuts the hashing pool down, a second startup must get a working one
+    for _ in range(2):
+        with TestClient(app) as client:
+            super_user_login(client)
@@ -0,0 +1,102 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire at an absolute unix timestamp.
+    A maxsize of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[Any, float | None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, expires_at: float | None = None) -> None:
+        if self.maxsize <= 0:
+            return
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class ExpiringSet:
+    """
+    Thread-safe set whose keys drop out at their own expiry timestamp.
+    Expired keys are evicted in expiry order from a heap, so memory stays
+    proportional to the number of live keys.
+    """
+
+    def __init__(self) -> None:
+        self._expiry: dict[Hashable, float] = {}
+        self._heap: list[tuple[float, Hashable]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        self.evict()
+        return len(self._expiry)
+
+    def __contains__(self, key: Hashable) -> bool:
+        self.evict()
+        return key in self._expiry
+
+    def add(self, key: Hashable, expires_at: float) -> None:
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            if self._expiry.get(key, 0) < expires_at:
+                self._expiry[key] = expires_at
+                heapq.heappush(self._heap, (expires_at, key))
+
+    def evict(self) -> None:
+        now = time.time()
+        if not self._heap or self._heap[0][0] > now:
+            return
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, key = heapq.heappop(self._heap)
+                if self._expiry.get(key) == expires_at:
+                    del self._expiry[key]
@@ -0,0 +1,105 @@
+"""
+Benchmark password hashing on this host and pick the highest cost that keeps
+one hash under the target latency, then write it to the .env file read by
+config.Settings.
+
+    python -m utils.calibrate_hash --scheme bcrypt --target-ms 250
+"""
+import argparse
+import statistics
+import time
+from pathlib import Path
+from typing import Callable
+
+SAMPLE_PASSWORD = "correct horse battery staple"
+
+
+def time_hash(hash_password: Callable[[str], str], samples: int) -> float:
+    """
+    Median milliseconds to hash the sample password.
+    """
+    # the first call loads the hashing backend
+    hash_password(SAMPLE_PASSWORD)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hash_password(SAMPLE_PASSWORD)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate_bcrypt(target_ms: float, samples: int) -> dict:
+    from passlib.hash import bcrypt
+
+    best = {"BCRYPT_ROUNDS": 4}
+    for rounds in range(4, 32):
+        elapsed = time_hash(bcrypt.using(rounds=rounds).hash, samples)
+        print(f"bcrypt rounds={rounds}: {elapsed:.1f} ms")
+        if elapsed > target_ms:
+            break
+        best = {"BCRYPT_ROUNDS": rounds}
+    return best
+
+
+def calibrate_argon2(
+    target_ms: float, samples: int, memory_cost: int, parallelism: int
+) -> dict:
+    from passlib.hash import argon2
+
+    best = {
+        "ARGON2_TIME_COST": 1,
+        "ARGON2_MEMORY_COST": memory_cost,
+        "ARGON2_PARALLELISM": parallelism,
+    }
+    for time_cost in range(1, 33):
+        handler = argon2.using(
+            time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism
+        )
+        elapsed = time_hash(handler.hash, samples)
+        print(f"argon2 time_cost={time_cost}: {elapsed:.1f} ms")
+        if elapsed > target_ms:
+            break
+        best["ARGON2_TIME_COST"] = time_cost
+    return best
+
+
+def write_env(path: Path, values: dict) -> None:
+    """
+    Set the values in the env file, keeping unrelated lines.
+    """
+    lines = path.read_text().splitlines() if path.exists() else []
+    lines = [line for line in lines if line.split("=", 1)[0].strip() not in values]
+    lines.extend(f"{key}={value}" for key, value in values.items())
+    path.write_text("\n".join(lines) + "\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scheme", choices=["bcrypt", "argon2"], default="bcrypt")
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--argon2-memory-cost", type=int, default=64 * 1024)
+    parser.add_argument("--argon2-parallelism", type=int, default=4)
+    parser.add_argument("--env-file", type=Path, default=Path(".env"))
+    parser.add_argument("--dry-run", action="store_true", help="print the result only")
+    args = parser.parse_args()
+
+    if args.scheme == "bcrypt":
+        values = calibrate_bcrypt(args.target_ms, args.samples)
+    else:
+        values = calibrate_argon2(
+            args.target_ms,
+            args.samples,
+            args.argon2_memory_cost,
+            args.argon2_parallelism,
+        )
+    values = {"PASSWORD_HASH_SCHEME": args.scheme, **values}
+    for key, value in values.items():
+        print(f"{key}={value}")
+    if not args.dry_run:
+        write_env(args.env_file, values)
+        print(f"written to {args.env_file}")
+
+
+if __name__ == "__main__":
+    main()
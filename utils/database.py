@@ -1,17 +1,242 @@
+import itertools
+import logging
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator
+
 from config import settings
-from sqlalchemy import create_engine
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import AsyncAdaptedQueuePool, Engine, create_engine, event, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.orm import declarative_base, sessionmaker
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# async drivers used when SQLALCHEMY_ASYNC_DATABASE_URL is not set
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def get_async_database_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+def get_engine_options(url: str) -> dict:
+    database_url = make_url(url)
+    options = {
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+    if database_url.get_backend_name() == "sqlite":
+        if database_url.database in (None, "", ":memory:"):
+            # in-memory databases keep their default single connection pools
+            return options
+        if database_url.get_driver_name() == "pysqlite":
+            options["connect_args"] = {"check_same_thread": False}
+        else:
+            # aiosqlite defaults to a NullPool, a connection per checkout
+            options["poolclass"] = AsyncAdaptedQueuePool
+    options.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+    )
+    return options
+
 
-# default to use sqlite
+# journal modes stored in the database file rather than per connection
+PERSISTENT_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "WAL"}
+
+
+def set_sqlite_journal_mode(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    cursor.close()
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+    # sqlite ignores ON DELETE CASCADE and other constraints without it
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# default to use sqlite, set SQLALCHEMY_DATABASE_URL to use postgres
 engine = create_engine(
-    settings.SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    settings.SQLALCHEMY_DATABASE_URL,
+    **get_engine_options(settings.SQLALCHEMY_DATABASE_URL),
 )
 
-# to use postgres db
-# engine = create_engine(settings.SQLALCHEMY_DATABASE_URL, echo=True)
-
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# async engine for the read routes, aiosqlite for sqlite, asyncpg for postgres
+ASYNC_DATABASE_URL = settings.SQLALCHEMY_ASYNC_DATABASE_URL or get_async_database_url(
+    settings.SQLALCHEMY_DATABASE_URL
+)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL, **get_engine_options(ASYNC_DATABASE_URL)
+)
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    seconds: float = 0.0
+
+
+# statements of the current request, set by QueryCountMiddleware
+request_query_stats: ContextVar[QueryStats | None] = ContextVar(
+    "request_query_stats", default=None
+)
+# open count_queries() blocks, which count statements of every thread
+_query_collectors: list[QueryStats] = []
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    conn.info["query_start"] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    elapsed = time.perf_counter() - conn.info["query_start"]
+    stats = request_query_stats.get()
+    collectors = _query_collectors if stats is None else [stats, *_query_collectors]
+    for stats in collectors:
+        stats.count += 1
+        stats.seconds += elapsed
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryStats]:
+    """
+    Count the statements run by both engines, from any thread, in the block.
+    """
+    stats = QueryStats()
+    _query_collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        _query_collectors.remove(stats)
+
+
+class QueryCountMiddleware:
+    """
+    Count the statements and database time of each request and log them,
+    at WARNING above DB_QUERY_COUNT_WARNING statements. With headers=True
+    also send them as X-DB-Query-Count and X-DB-Query-Time-ms.
+    Statements run after the response has started, e.g. while streaming,
+    are logged but not in the headers.
+    """
+
+    def __init__(self, app: ASGIApp, headers: bool = False) -> None:
+        self.app = app
+        self.headers = headers
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+
+        async def send_wrapper(message: Message) -> None:
+            if self.headers and message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-DB-Query-Count"] = str(stats.count)
+                headers["X-DB-Query-Time-ms"] = f"{stats.seconds * 1000:.2f}"
+            await send(message)
+
+        token = request_query_stats.set(stats)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_query_stats.reset(token)
+            level = (
+                logging.WARNING
+                if stats.count > settings.DB_QUERY_COUNT_WARNING
+                else logging.DEBUG
+            )
+            logger.log(
+                level,
+                "%s %s ran %d queries in %.2f ms",
+                scope["method"],
+                scope["path"],
+                stats.count,
+                stats.seconds * 1000,
+            )
+
+
+def instrument_engine(sync_engine: Engine) -> None:
+    if sync_engine.dialect.name == "sqlite":
+        # a persistent journal mode is set once, by the first connection
+        if settings.SQLITE_JOURNAL_MODE.upper() in PERSISTENT_JOURNAL_MODES:
+            event.listen(sync_engine, "first_connect", set_sqlite_journal_mode)
+        else:
+            event.listen(sync_engine, "connect", set_sqlite_journal_mode)
+        event.listen(sync_engine, "connect", set_sqlite_pragmas)
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+_replica_sync_engines: weakref.WeakSet[Engine] = weakref.WeakSet()
+
+
+def create_replica_engine(url: str) -> AsyncEngine:
+    replica_url = get_async_database_url(url)
+    replica_engine = create_async_engine(replica_url, **get_engine_options(replica_url))
+    instrument_engine(replica_engine.sync_engine)
+    _replica_sync_engines.add(replica_engine.sync_engine)
+    return replica_engine
+
+
+def reads_from_replica(db: AsyncSession) -> bool:
+    """
+    Whether the session is bound to a replica, whose rows may lag the primary.
+    """
+    return db.get_bind() in _replica_sync_engines
+
+
+for sync_engine in (engine, async_engine.sync_engine):
+    instrument_engine(sync_engine)
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
+# read-only async engines, used round robin by get_read_db
+replica_engines = [
+    create_replica_engine(url) for url in settings.SQLALCHEMY_REPLICA_URLS
+]
+ReplicaSessionLocals = [
+    async_sessionmaker(
+        bind=replica_engine,
+        class_=AsyncSession,
+        autoflush=False,
+        expire_on_commit=False,
+    )
+    for replica_engine in replica_engines
+]
+_replica_counter = itertools.count()
+# holds the unix time until which the client's reads go to the primary
+PRIMARY_COOKIE = "read_primary_until"
+
 Base = declarative_base()
 
 
@@ -22,3 +247,73 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Async dependency
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Async read-only dependency
+async def get_read_db(request: Request):
+    """
+    A session on the next replica, or on the primary when there are no
+    replicas or the client wrote recently, see pin_reads_to_primary.
+    """
+    session_factory = AsyncSessionLocal
+    if ReplicaSessionLocals and not reads_pinned_to_primary(request):
+        index = next(_replica_counter) % len(ReplicaSessionLocals)
+        session_factory = ReplicaSessionLocals[index]
+    async with session_factory() as db:
+        yield db
+
+
+def reads_pinned_to_primary(request: Request) -> bool:
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+async def pin_reads_to_primary(response: Response) -> None:
+    """
+    Dependency of write routes, the client then reads from the primary for
+    READ_YOUR_WRITES_SECONDS, so it sees its writes despite replication lag.
+    """
+    if ReplicaSessionLocals and settings.READ_YOUR_WRITES_SECONDS > 0:
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            str(int(time.time()) + settings.READ_YOUR_WRITES_SECONDS),
+            max_age=settings.READ_YOUR_WRITES_SECONDS,
+            httponly=True,
+            samesite="lax",
+        )
+
+
+def prepare_database(create_all: bool, warmup: int) -> None:
+    """
+    Create missing tables, then open warmup pooled connections and return
+    them to the pool.
+    """
+    if create_all:
+        Base.metadata.create_all(bind=engine)
+    connections = [engine.connect() for _ in range(warmup)]
+    for connection in connections:
+        connection.close()
+
+
+async def init_db() -> None:
+    await run_in_threadpool(
+        prepare_database, settings.DB_CREATE_ALL, settings.DB_POOL_WARMUP
+    )
+    # the first connection initializes the dialect
+    for read_engine in (async_engine, *replica_engines):
+        async with read_engine.connect():
+            pass
+
+
+async def close_db() -> None:
+    engine.dispose()
+    for read_engine in (async_engine, *replica_engines):
+        await read_engine.dispose()
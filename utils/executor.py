@@ -0,0 +1,73 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class ExecutorOverloaded(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool which admits at most max_workers + max_queue calls at a time.
+    Calls beyond that limit are rejected instead of queueing without bound.
+    """
+
+    def __init__(
+        self, max_workers: int, max_queue: int, thread_name_prefix: str = ""
+    ) -> None:
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = self._new_executor()
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        """
+        Calls running or waiting for a worker.
+        """
+        return self._pending
+
+    def submit(self, fn: Callable, *args: Any, block: bool = False) -> Future:
+        """
+        Submit a call, raise ExecutorOverloaded if no slot is free.
+        With block=True wait for a free slot instead.
+        """
+        if not self._slots.acquire(blocking=block):
+            raise ExecutorOverloaded(
+                f"more than {self.max_workers + self.max_queue} pending calls"
+            )
+        with self._pending_lock:
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self) -> None:
+        with self._pending_lock:
+            self._pending -= 1
+        self._slots.release()
+
+    async def run(self, fn: Callable, *args: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def _new_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix
+        )
+
+    def shutdown(self) -> None:
+        """
+        Wait for pending calls and stop the workers. The executor stays usable,
+        later calls start a new pool, so an app can start up again.
+        """
+        executor, self._executor = self._executor, self._new_executor()
+        executor.shutdown(wait=True)
@@ -0,0 +1,236 @@
+"""
+Interchangeable JWT encoders/decoders used by utils.keys.KeyRing.
+Every codec prepares its key objects once, and raises jose's JWTError for
+any invalid token, so callers don't depend on the backend.
+"""
+import base64
+import binascii
+import calendar
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime
+from typing import Any
+
+from jose.exceptions import ExpiredSignatureError, JWTClaimsError, JWTError
+
+HMAC_DIGESTS = {
+    "HS256": hashlib.sha256,
+    "HS384": hashlib.sha384,
+    "HS512": hashlib.sha512,
+}
+
+
+def b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def b64decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+class JoseCodec:
+    """
+    python-jose, supports HS*, RS* and ES*.
+    """
+
+    def __init__(self, algorithm: str) -> None:
+        from jose import jwk, jwt
+        from jose.constants import ALGORITHMS
+
+        if algorithm not in ALGORITHMS.SUPPORTED:
+            raise ValueError(
+                f"The jose JWT backend doesn't support {algorithm}, "
+                "use JWT_BACKEND=pyjwt"
+            )
+        self.algorithm = algorithm
+        self._jwk = jwk
+        self._jwt = jwt
+
+    def prepare_keys(self, material: str) -> tuple[Any, Any]:
+        """
+        Return the signing and verifying keys for a secret or PEM private key.
+        """
+        key = self._jwk.construct(material, self.algorithm)
+        if self.algorithm.startswith("HS"):
+            return key, key
+        return key, key.public_key()
+
+    def public_jwk(self, public_key: Any) -> dict:
+        return public_key.to_dict()
+
+    def get_unverified_header(self, token: str) -> dict:
+        return self._jwt.get_unverified_header(token)
+
+    def encode(self, claims: dict, key: Any, kid: str | None = None) -> str:
+        headers = None if kid is None else {"kid": kid}
+        return self._jwt.encode(claims, key, algorithm=self.algorithm, headers=headers)
+
+    def decode(self, token: str, key: Any) -> dict:
+        return self._jwt.decode(token, key, algorithms=[self.algorithm])
+
+
+class PyJWTCodec:
+    """
+    PyJWT, supports HS*, RS*, ES* and EdDSA. Needs `poetry install -E pyjwt`.
+    """
+
+    def __init__(self, algorithm: str) -> None:
+        try:
+            import jwt
+        except ImportError as e:
+            raise ValueError(
+                f"The pyjwt JWT backend for {algorithm} needs "
+                "`poetry install -E pyjwt`"
+            ) from e
+        from cryptography.hazmat.primitives import serialization
+
+        self.algorithm = algorithm
+        self._jwt = jwt
+        self._serialization = serialization
+        self._algorithm = jwt.algorithms.get_default_algorithms()[algorithm]
+
+    def prepare_keys(self, material: str) -> tuple[Any, Any]:
+        if self.algorithm.startswith("HS"):
+            key = self._algorithm.prepare_key(material)
+            return key, key
+        private_key = self._serialization.load_pem_private_key(
+            material.encode(), password=None
+        )
+        return private_key, private_key.public_key()
+
+    def public_jwk(self, public_key: Any) -> dict:
+        jwk = self._algorithm.to_jwk(public_key)
+        # older PyJWT versions return the JWK as a JSON string
+        return json.loads(jwk) if isinstance(jwk, str) else jwk
+
+    def get_unverified_header(self, token: str) -> dict:
+        try:
+            return self._jwt.get_unverified_header(token)
+        except self._jwt.PyJWTError as e:
+            raise JWTError(str(e)) from e
+
+    def encode(self, claims: dict, key: Any, kid: str | None = None) -> str:
+        headers = None if kid is None else {"kid": kid}
+        return self._jwt.encode(claims, key, algorithm=self.algorithm, headers=headers)
+
+    def decode(self, token: str, key: Any) -> dict:
+        try:
+            return self._jwt.decode(token, key, algorithms=[self.algorithm])
+        except self._jwt.ExpiredSignatureError as e:
+            raise ExpiredSignatureError(str(e)) from e
+        except self._jwt.PyJWTError as e:
+            raise JWTError(str(e)) from e
+
+
+class HMACCodec:
+    """
+    Built-in HS256/HS384/HS512 codec. The key is an HMAC object copied per
+    token instead of rebuilt, and the encoded header segment is computed once
+    per kid. Only exp and nbf are validated, which is all the app issues.
+    """
+
+    def __init__(self, algorithm: str) -> None:
+        if algorithm not in HMAC_DIGESTS:
+            raise ValueError(f"The builtin JWT backend doesn't support {algorithm}")
+        self.algorithm = algorithm
+        self._digest = HMAC_DIGESTS[algorithm]
+        self._headers: dict[str | None, bytes] = {}
+
+    def prepare_keys(self, material: str) -> tuple[Any, Any]:
+        key = hmac.new(material.encode(), digestmod=self._digest)
+        return key, key
+
+    def public_jwk(self, public_key: Any) -> dict:
+        raise ValueError("HMAC keys are secret")
+
+    def header_segment(self, kid: str | None) -> bytes:
+        segment = self._headers.get(kid)
+        if segment is None:
+            header = {"alg": self.algorithm, "typ": "JWT"}
+            if kid is not None:
+                header["kid"] = kid
+            # same bytes as python-jose produces
+            segment = b64encode(
+                json.dumps(header, separators=(",", ":"), sort_keys=True).encode()
+            )
+            self._headers[kid] = segment
+        return segment
+
+    def get_unverified_header(self, token: str) -> dict:
+        try:
+            header = json.loads(b64decode(token.encode().partition(b".")[0]))
+        except (ValueError, binascii.Error) as e:
+            raise JWTError("Invalid header") from e
+        if not isinstance(header, dict):
+            raise JWTError("Invalid header")
+        return header
+
+    def encode(self, claims: dict, key: Any, kid: str | None = None) -> str:
+        if any(isinstance(value, datetime) for value in claims.values()):
+            claims = {
+                name: calendar.timegm(value.utctimetuple())
+                if isinstance(value, datetime)
+                else value
+                for name, value in claims.items()
+            }
+        signing_input = (
+            self.header_segment(kid)
+            + b"."
+            + b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        )
+        mac = key.copy()
+        mac.update(signing_input)
+        return (signing_input + b"." + b64encode(mac.digest())).decode()
+
+    def decode(self, token: str, key: Any) -> dict:
+        try:
+            signing_input, _, signature = token.encode().rpartition(b".")
+            header, _, payload = signing_input.partition(b".")
+            if header not in self._headers.values():
+                if self.get_unverified_header(token).get("alg") != self.algorithm:
+                    raise JWTError("The specified alg value is not allowed")
+            mac = key.copy()
+            mac.update(signing_input)
+            if not hmac.compare_digest(b64encode(mac.digest()), signature):
+                raise JWTError("Signature verification failed.")
+            claims = json.loads(b64decode(payload))
+        except (ValueError, binascii.Error) as e:
+            raise JWTError("Error decoding token") from e
+        if not isinstance(claims, dict):
+            raise JWTError("Invalid payload")
+        now = time.time()
+        exp = claims.get("exp")
+        if exp is not None:
+            if not isinstance(exp, (int, float)):
+                raise JWTClaimsError("Expiration Time claim (exp) must be a number.")
+            if exp < now:
+                raise ExpiredSignatureError("Signature has expired.")
+        nbf = claims.get("nbf")
+        if nbf is not None:
+            if not isinstance(nbf, (int, float)):
+                raise JWTClaimsError("Not Before claim (nbf) must be a number.")
+            if nbf > now:
+                raise JWTClaimsError("The token is not yet valid (nbf)")
+        return claims
+
+
+CODECS = {"jose": JoseCodec, "pyjwt": PyJWTCodec, "builtin": HMACCodec}
+
+
+def get_codec(backend: str, algorithm: str):
+    """
+    "auto" picks the builtin codec for HS*, PyJWT for EdDSA and python-jose
+    otherwise.
+    """
+    if backend == "auto":
+        if algorithm in HMAC_DIGESTS:
+            backend = "builtin"
+        elif algorithm == "EdDSA":
+            backend = "pyjwt"
+        else:
+            backend = "jose"
+    if backend not in CODECS:
+        raise ValueError(f"Unknown JWT backend {backend}")
+    return CODECS[backend](algorithm)
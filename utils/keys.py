@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from jose.exceptions import JWTError
+from utils.jwt_codec import JoseCodec
+
+logger = logging.getLogger(__name__)
+
+EC_CURVES = {
+    "ES256": "SECP256R1",
+    "ES384": "SECP384R1",
+    "ES512": "SECP521R1",
+}
+
+
+def generate_private_key(algorithm: str) -> str:
+    # only needed for asymmetric algorithms, imported on use
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+    if algorithm.startswith("RS"):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm in EC_CURVES:
+        private_key = ec.generate_private_key(getattr(ec, EC_CURVES[algorithm])())
+    elif algorithm == "EdDSA":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f"Unsupported token signing algorithm {algorithm}")
+    return private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+@dataclass
+class SigningKey:
+    kid: str | None
+    # key objects prepared by the codec
+    private_key: Any
+    public_key: Any
+    created_at: float
+    retired_at: float | None = None
+    # file_version of the file the key was loaded from
+    version: tuple | None = None
+    # when it starts signing, published in the JWKS before that
+    active_at: float = 0.0
+
+
+def file_version(path: Path) -> tuple:
+    """
+    Changes when the file is rewritten or replaced.
+    """
+    stat = path.stat()
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class KeyRing:
+    """
+    Keys to sign and verify access tokens, looked up by the kid header.
+    HS* algorithms use the shared secret and publish nothing. Other algorithms
+    sign with the newest key and publish all live public keys as a JWKS.
+    Without keys_dir, keys are generated in process and rotated every
+    rotation_minutes, retired keys keep verifying for retention_minutes.
+    HS* algorithms can read the secret from secret_key_file instead, tokens
+    then carry a kid derived from the secret.
+    Key files are checked for changes every reload_seconds, None to never,
+    and only changed files are parsed again. Keys of removed files keep
+    verifying for retention_minutes.
+    New asymmetric keys, rotated or from new files, are published for
+    publish_seconds before they sign, so verifiers caching the JWKS for up
+    to that long know them.
+    Tokens are encoded and decoded by codec, python-jose by default.
+    """
+
+    def __init__(
+        self,
+        algorithm: str,
+        secret_key: str,
+        keys_dir: str | None = None,
+        rotation_minutes: int = 0,
+        retention_minutes: int = 0,
+        codec=None,
+        secret_key_file: str | None = None,
+        reload_seconds: float | None = None,
+        publish_seconds: float = 0,
+    ) -> None:
+        self.algorithm = algorithm
+        self.codec = codec or JoseCodec(algorithm)
+        self.symmetric = algorithm.startswith("HS")
+        self.keys_dir = keys_dir
+        self.secret_key_file = secret_key_file if self.symmetric else None
+        self.rotation_seconds = rotation_minutes * 60
+        self.retention_seconds = retention_minutes * 60
+        self.reload_seconds = reload_seconds
+        # nothing caches symmetric keys, the secret is never published
+        self.publish_seconds = 0 if self.symmetric else publish_seconds
+        self._lock = threading.Lock()
+        self._keys: dict[str | None, SigningKey] = {}
+        # published key waiting for its active_at
+        self._next_key: SigningKey | None = None
+        self._jwks: tuple[bytes, str] | None = None
+        self._version: tuple | None = None
+        self._checked_at = time.monotonic()
+        if self.secret_key_file:
+            self.load_secret(self.secret_key_file)
+        elif self.symmetric:
+            private_key, public_key = self.codec.prepare_keys(secret_key)
+            now = time.time()
+            self._signing_key = SigningKey(
+                None, private_key, public_key, now, active_at=now
+            )
+            self._keys[None] = self._signing_key
+        elif keys_dir:
+            self.load(keys_dir)
+        else:
+            self.rotate()
+
+    def load(self, keys_dir: str) -> None:
+        """
+        Load <kid>.pem private keys, the last kid in sort order signs.
+        """
+        version = self._files_version()
+        now = time.time()
+        # keys found on reload sign once published, those at startup at once
+        active_at = now + self.publish_seconds if self._keys else now
+        keys = {}
+        for path in sorted(Path(keys_dir).glob("*.pem")):
+            key = self._keys.get(path.stem)
+            if key is None or key.version != file_version(path):
+                private_key, public_key = self.codec.prepare_keys(path.read_text())
+                key = SigningKey(
+                    path.stem,
+                    private_key,
+                    public_key,
+                    now,
+                    version=file_version(path),
+                    active_at=now if path.stem in self._keys else active_at,
+                )
+            keys[path.stem] = key
+        if not keys:
+            raise ValueError(f"No *.pem signing keys found in {keys_dir}")
+        newest = keys[max(keys)]
+        active = [kid for kid, key in keys.items() if key.active_at <= now]
+        # keys of removed files retire now
+        for kid, key in self._keys.items():
+            if kid not in keys:
+                key.retired_at = min(key.retired_at or now, now)
+                if not self._expired(key):
+                    keys[kid] = key
+        with self._lock:
+            self._keys = keys
+            self._signing_key = keys[max(active)] if active else newest
+            self._next_key = newest if newest is not self._signing_key else None
+            self._jwks = None
+            self._version = version
+
+    def load_secret(self, path: str) -> None:
+        """
+        Sign with the secret in the file, the previous secret retires.
+        """
+        version = self._files_version()
+        secret = Path(path).read_text().strip()
+        if not secret:
+            raise ValueError(f"No secret key in {path}")
+        # the same on every worker, without revealing the secret
+        kid = hashlib.sha256(secret.encode()).hexdigest()[:16]
+        if self._keys and self._signing_key.kid == kid:
+            self._version = version
+            return
+        private_key, public_key = self.codec.prepare_keys(secret)
+        now = time.time()
+        self._add_signing_key(
+            SigningKey(kid, private_key, public_key, now, active_at=now)
+        )
+        self._version = version
+
+    def _files_version(self) -> tuple | None:
+        if self.secret_key_file:
+            return file_version(Path(self.secret_key_file))
+        if self.keys_dir:
+            return tuple(
+                (path.name, file_version(path))
+                for path in sorted(Path(self.keys_dir).glob("*.pem"))
+            )
+        return None
+
+    def reload_if_changed(self) -> None:
+        """
+        Reload the key files if they changed, at most every reload_seconds.
+        A missing or invalid file keeps the current keys.
+        """
+        if self.reload_seconds is None or self._version is None:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_seconds:
+            return
+        self._checked_at = now
+        try:
+            if self._files_version() == self._version:
+                return
+            if self.secret_key_file:
+                self.load_secret(self.secret_key_file)
+            else:
+                self.load(self.keys_dir)
+        except (OSError, ValueError) as e:
+            logger.warning("Keeping the current signing keys: %s", e)
+
+    def rotate(self) -> None:
+        """
+        Publish a new key, which signs after publish_seconds.
+        """
+        private_key, public_key = self.codec.prepare_keys(
+            generate_private_key(self.algorithm)
+        )
+        now = time.time()
+        self._add_signing_key(
+            SigningKey(
+                uuid.uuid4().hex,
+                private_key,
+                public_key,
+                now,
+                active_at=now + self.publish_seconds if self._keys else now,
+            )
+        )
+
+    def _add_signing_key(self, new_key: SigningKey) -> None:
+        with self._lock:
+            # the current keys retire once the new key signs
+            for key in self._keys.values():
+                if key.retired_at is None:
+                    key.retired_at = new_key.active_at
+            self._keys = {
+                kid: key for kid, key in self._keys.items() if not self._expired(key)
+            }
+            self._keys[new_key.kid] = new_key
+            if new_key.active_at <= time.time():
+                self._signing_key = new_key
+                self._next_key = None
+            else:
+                self._next_key = new_key
+            self._jwks = None
+
+    def _expired(self, key: SigningKey) -> bool:
+        return (
+            key.retired_at is not None
+            and key.retired_at + self.retention_seconds < time.time()
+        )
+
+    def signing_key(self) -> SigningKey:
+        self.reload_if_changed()
+        now = time.time()
+        next_key = self._next_key
+        if next_key is not None and next_key.active_at <= now:
+            with self._lock:
+                if self._next_key is next_key:
+                    self._signing_key = next_key
+                    self._next_key = None
+        # publish the next key early enough to sign every rotation_seconds
+        if (
+            self.rotation_seconds
+            and not self.symmetric
+            and not self.keys_dir
+            and self._next_key is None
+            and now - self._signing_key.active_at
+            >= self.rotation_seconds - self.publish_seconds
+        ):
+            self.rotate()
+        return self._signing_key
+
+    def encode(self, claims: dict) -> str:
+        key = self.signing_key()
+        return self.codec.encode(claims, key.private_key, key.kid)
+
+    def decode(self, token: str) -> dict:
+        self.reload_if_changed()
+        if self.symmetric and not self.secret_key_file:
+            key = self._signing_key
+        else:
+            kid = self.codec.get_unverified_header(token).get("kid")
+            key = self._keys.get(kid)
+            if key is None or self._expired(key):
+                raise JWTError("Unknown signing key")
+        return self.codec.decode(token, key.public_key)
+
+    def jwks(self) -> tuple[bytes, str]:
+        """
+        Return the encoded JWKS and its ETag, rebuilt only when keys change.
+        """
+        jwks = self._jwks
+        if jwks is None:
+            keys = [
+                {**self.codec.public_jwk(key.public_key), "kid": key.kid, "use": "sig"}
+                for key in self._keys.values()
+                if not self.symmetric and not self._expired(key)
+            ]
+            content = json.dumps({"keys": keys}).encode()
+            jwks = (content, '"' + hashlib.sha256(content).hexdigest()[:32] + '"')
+            self._jwks = jwks
+        return jwks
@@ -0,0 +1,275 @@
+"""
+Minimal metrics registry rendered in the Prometheus text exposition format.
+"""
+import bisect
+import threading
+import time
+from typing import Any, Callable, Iterable
+
+from fastapi.responses import ORJSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# seconds, from a cached token check up to a slow password hash
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A value that only goes up. When callback is set, the values are collected
+    from it at render time as {label_values: value}.
+    """
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        callback: Callable[[], dict] | None = None,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.callback = callback
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self) -> Iterable[str]:
+        if self.callback is not None:
+            values = dict(self.callback())
+            with self._lock:
+                self._values = values
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}{labels} {format_value(value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values: str, value: float) -> None:
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *label_values: str, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *label_values: str) -> int:
+        counts = self._values.get(label_values)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        names = self.labels + ("le",)
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(names, label_values + (format_value(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {format_value(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        callback: Callable[[], dict] | None = None,
+    ) -> Counter:
+        return self.register(Counter(name, documentation, labels, callback))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        callback: Callable[[], dict] | None = None,
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, callback))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return ("\n".join(lines) + "\n").encode()
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request, by route template.",
+    labels=("method", "route", "status"),
+)
+requests_in_progress = registry.gauge(
+    "http_requests_in_progress", "HTTP requests being handled."
+)
+stage_duration = registry.histogram(
+    "app_stage_duration_seconds",
+    "Time spent in one stage of request handling.",
+    labels=("stage",),
+)
+
+
+class stage:
+    """
+    Time the enclosed block into app_stage_duration_seconds{stage=name}.
+    Works around awaits, which are timed as wall clock.
+    """
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        stage_duration.observe(self.name, value=time.perf_counter() - self.start)
+
+
+class TimedJSONResponse(ORJSONResponse):
+    """
+    JSON response encoded with orjson, timed as the response.render stage.
+    """
+
+    def render(self, content: Any) -> bytes:
+        with stage("response.render"):
+            return super().render(content)
+
+
+class MetricsMiddleware:
+    """
+    Record the latency of every HTTP request by method, route template and
+    status code. Paths matching no route share the "unmatched" label, so
+    scanners can't grow the number of series.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        requests_in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            requests_in_progress.dec()
+            # the router stores the matched route in the scope
+            route = scope.get("route")
+            request_duration.observe(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code),
+                value=time.perf_counter() - start,
+            )
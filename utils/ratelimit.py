@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBucketStore:
+    """
+    Token buckets of one process, bounded to max_keys with LRU eviction.
+    An evicted bucket comes back full, which only errs on the lenient side.
+    """
+
+    blocking = False
+
+    def __init__(self, max_keys: int) -> None:
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: str, rate: float, burst: int, now: float) -> float:
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, retry_after = take_token(tokens, updated, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class SQLiteBucketStore:
+    """
+    Token buckets in a local sqlite file, shared by all workers on a host.
+    Buckets that have refilled completely are pruned every prune_every calls.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, prune_every: int = 1000) -> None:
+        self.path = path
+        self.prune_every = prune_every
+        self._calls = 0
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_buckets_full_at ON buckets (full_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def take(self, key: str, rate: float, burst: int, now: float) -> float:
+        connection = self._connect()
+        # IMMEDIATE takes the write lock up front, so read-modify-write is atomic
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, retry_after = take_token(tokens, updated, rate, burst, now)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (burst - tokens) / rate),
+            )
+            self._calls += 1
+            if self._calls % self.prune_every == 0:
+                connection.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return retry_after
+
+
+def take_token(
+    tokens: float, updated: float, rate: float, burst: int, now: float
+) -> tuple[float, float]:
+    """
+    Refill the bucket and take one token.
+    Return the tokens left and the seconds to wait, 0 if a token was taken.
+    """
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class TokenBucketLimiter:
+    """
+    Allow `burst` calls per key at once, refilled at `rate` calls per second.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        store: MemoryBucketStore | SQLiteBucketStore,
+    ) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.store = store
+
+    def acquire(self, key: str) -> float:
+        """
+        Take a token for key, return 0 or the seconds to wait for one.
+        """
+        return self.store.take(f"{self.name}:{key}", self.rate, self.burst, time.time())